@@ -0,0 +1,382 @@
+"""
+Офлайн-бенчмарк бота: локальный поддельный Bot API + поддельные сайты (HTML-страницы и oEmbed).
+N пользователей одновременно проходят весь сценарий router: ссылка → альбом → категория → теги →
+кредиты → finalize_and_post → публикация воркером очереди. В конце — апдейтов/с и p50/p95/p99
+по хендлерам, стратегиям заголовка, вызовам Bot API и шагам пользователя.
+
+  python bench.py --users 50 --api-latency 0.02 --content-latency 0.05 --rate-429 0.1
+
+Ничего не ходит наружу: база — во временном каталоге, yt-dlp по умолчанию выключен (--strategies).
+Лимиты публикации по умолчанию сняты (меряем бота, а не Telegram); --real-limits — как в проде.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+BENCH_DIR = tempfile.mkdtemp(prefix="refbot-bench-")
+BENCH_TOKEN = "42:BENCH"
+BENCH_CHANNEL = "@bench_channel"
+BENCH_CHANNEL_ID = -1001000000000
+
+# Конфиг main.py читается при импорте — окружение выставляем до него
+os.environ.setdefault("DB_PATH", os.path.join(BENCH_DIR, "bench.db"))
+os.environ["TELEGRAM_BOT_TOKEN"] = BENCH_TOKEN
+os.environ["TELEGRAM_CHANNEL_ID"] = BENCH_CHANNEL
+os.environ.setdefault("PHASH_ENABLED", "0")
+os.environ.setdefault("ARCHIVE_ENABLED", "0")
+os.environ.setdefault("YTDLP_POOL_SIZE", "0")
+os.environ.setdefault("ROUTE_EXPLORE", "0")
+if "--real-limits" not in sys.argv:
+    os.environ.setdefault("PUBLISH_GLOBAL_RATE", "10000")
+    os.environ.setdefault("PUBLISH_CHAT_RATE", "600000")
+    os.environ.setdefault("PUBLISH_CHAT_BURST", "10000")
+    os.environ.setdefault("PUBLISH_WORKERS", "8")
+
+from aiohttp import web  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.client.default import DefaultBotProperties  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.enums import ParseMode  # noqa: E402
+
+import main  # noqa: E402
+
+STEP_TIMEOUT = 60.0  # сек. на ответ бота на один шаг пользователя
+QUANTILES = (0.5, 0.95, 0.99)
+# Гистограммы в отчёте: (заголовок, метрика, метки строки); сырые значения копим ради точных перцентилей
+HISTOGRAMS = (
+    ("Хендлеры", "refbot_handler_seconds", ("handler",)),
+    ("Стратегии заголовка", "refbot_title_strategy_seconds", ("strategy", "outcome")),
+    ("Резолв заголовка целиком", "refbot_title_resolve_seconds", ("strategy",)),
+    ("Bot API", "refbot_telegram_seconds", ("method",)),
+    ("SQLite", "refbot_db_seconds", ("op",)),
+)
+main.metrics.keep_samples(*(name for _, name, _ in HISTOGRAMS))
+
+# ---------- Поддельный Bot API ----------
+class ApiError(Exception):
+    def __init__(self, code: int, description: str):
+        super().__init__(description)
+        self.code = code
+        self.description = description
+
+class FakeBotApi:
+    """
+    /bot<token>/<method>: getUpdates (long polling из очереди), send*/edit* (сообщения запоминаются
+    по чатам, чтобы сценарий мог дождаться ответа), остальное — True. Задержка на каждый запрос,
+    429 с retry_after для sendMediaGroup с вероятностью rate_429 (путь публикации с повторами).
+    """
+
+    RATE_LIMITED = {"sendMediaGroup"}
+
+    def __init__(self, latency: float, rate_429: float, retry_after: int = 1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.updates: List[Dict[str, Any]] = []
+        self._new_update = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self.events: Dict[int, List[Tuple[str, str]]] = {}  # chat_id -> [(method, text)]
+        self._changed = asyncio.Condition()
+        self.calls: Dict[str, int] = {}
+        self.injected_429 = 0
+        self._reply_kb: set = set()  # (chat_id, message_id) с reply-клавиатурой — Telegram их не правит
+        self.rejected_edits = 0
+
+    # --- сценарий ---
+    def push(self, kind: str, payload: Dict[str, Any]) -> None:
+        self.updates.append({"update_id": next(self._update_ids), kind: payload})
+        self._new_update.set()
+
+    def next_message_id(self) -> int:
+        return next(self._message_ids)
+
+    async def wait_for(self, chat_id: int, since: int, match: Callable[[str, str], bool]) -> int:
+        """Ждёт событие чата после позиции since, подходящее под match(method, text); возвращает новую позицию."""
+        async with self._changed:
+            while True:
+                events = self.events.get(chat_id, [])
+                for i in range(since, len(events)):
+                    if match(*events[i]):
+                        return i + 1
+                await asyncio.wait_for(self._changed.wait(), STEP_TIMEOUT)
+
+    # --- HTTP ---
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        return app
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        form = dict(await request.post())
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(form))
+        await asyncio.sleep(self.latency)
+        if method in self.RATE_LIMITED and random.random() < self.rate_429:
+            self.injected_429 += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        try:
+            return self._ok(await self._call(method, form))
+        except ApiError as e:
+            return web.json_response({"ok": False, "error_code": e.code, "description": e.description})
+
+    @staticmethod
+    def _ok(result: Any) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, form: Dict[str, str]) -> List[Dict[str, Any]]:
+        offset = int(form.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self._new_update.clear()
+            try:
+                await asyncio.wait_for(self._new_update.wait(), float(form.get("timeout") or 0) or 0.1)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    def _chat(self, chat_id: str) -> Dict[str, Any]:
+        if str(chat_id) in (BENCH_CHANNEL, str(BENCH_CHANNEL_ID)):
+            return {"id": BENCH_CHANNEL_ID, "type": "channel", "title": "bench"}
+        return {"id": int(chat_id), "type": "private"}
+
+    def _message(self, chat_id: str, text: Optional[str] = None, message_id: Optional[int] = None) -> Dict[str, Any]:
+        msg = {"message_id": message_id or self.next_message_id(), "date": int(time.time()), "chat": self._chat(chat_id)}
+        if text is not None:
+            msg["text"] = text
+        return msg
+
+    async def _record(self, chat_id: Any, method: str, text: str) -> None:
+        async with self._changed:
+            self.events.setdefault(int(self._chat(chat_id)["id"]), []).append((method, text))
+            self._changed.notify_all()
+
+    async def _call(self, method: str, form: Dict[str, str]) -> Any:
+        chat_id = form.get("chat_id")
+        if method == "getMe":
+            return {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method == "sendMessage":
+            await self._record(chat_id, method, form.get("text", ""))
+            msg = self._message(chat_id, form.get("text", ""))
+            if '"keyboard"' in form.get("reply_markup", ""):
+                self._reply_kb.add((str(chat_id), msg["message_id"]))
+            return msg
+        if method == "sendMediaGroup":
+            media = json.loads(form.get("media") or "[]")
+            await self._record(chat_id, method, (media[0].get("caption") if media else "") or "")
+            return [self._message(chat_id) for _ in media]
+        if method in ("editMessageText", "editMessageReplyMarkup", "editMessageCaption"):
+            if chat_id is None:
+                return True
+            if (str(chat_id), int(form.get("message_id") or 0)) in self._reply_kb:
+                self.rejected_edits += 1
+                raise ApiError(400, "Bad Request: message can't be edited")
+            text = form.get("text") or form.get("caption") or ""
+            await self._record(chat_id, method, text)
+            return self._message(chat_id, text or None, int(form.get("message_id") or 0) or None)
+        return True
+
+# ---------- Поддельные сайты ----------
+class FakeContent:
+    """/page/<id> — HTML c og:title; /v/<id> — «видеохостинг» с oEmbed на /oembed?url=..."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.hits: Dict[str, int] = {}
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/page/{id}", self._page)
+        app.router.add_get("/v/{id}", self._page)
+        app.router.add_get("/oembed", self._oembed)
+        return app
+
+    async def _jitter(self, kind: str) -> None:
+        self.hits[kind] = self.hits.get(kind, 0) + 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    async def _page(self, request: web.Request) -> web.Response:
+        await self._jitter("page")
+        ref = request.match_info["id"]
+        html = (
+            "<!doctype html><html><head><meta charset='utf-8'>"
+            f"<title>Page {ref} - Site</title><meta property='og:title' content='Reference {ref}'>"
+            "</head><body>" + "<p>lorem ipsum</p>" * 200 + "</body></html>"
+        )
+        return web.Response(text=html, content_type="text/html")
+
+    async def _oembed(self, request: web.Request) -> web.Response:
+        await self._jitter("oembed")
+        url = request.query.get("url", "")
+        return web.json_response({"type": "video", "title": f"Video {url.rsplit('/', 1)[-1]}"})
+
+# ---------- Сценарий пользователя ----------
+class User:
+    """Один пользователь: шаги сценария, после каждого — ждём нужный ответ бота, меряем время шага."""
+
+    def __init__(self, api: FakeBotApi, uid: int, link: str, album: int, step_times: Dict[str, List[float]]):
+        self.api = api
+        self.uid = uid
+        self.link = link
+        self.album = album
+        self.step_times = step_times
+        self.sent = 0
+        self._pos = 0
+
+    def _from(self) -> Dict[str, Any]:
+        return {"id": self.uid, "is_bot": False, "first_name": f"user{self.uid}"}
+
+    def _msg(self, **fields: Any) -> Dict[str, Any]:
+        return {"message_id": self.api.next_message_id(), "date": int(time.time()),
+                "chat": {"id": self.uid, "type": "private"}, "from": self._from(), **fields}
+
+    def text(self, text: str) -> None:
+        fields: Dict[str, Any] = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        self.api.push("message", self._msg(**fields))
+        self.sent += 1
+
+    def photos(self, n: int) -> None:
+        group = f"g{self.uid}-{time.monotonic_ns()}"
+        for i in range(n):
+            photo = [{"file_id": f"ph-{self.uid}-{i}", "file_unique_id": f"u-{self.uid}-{i}", "width": 1280, "height": 720}]
+            self.api.push("message", self._msg(photo=photo, media_group_id=group))
+            self.sent += 1
+
+    def press(self, data: str) -> None:
+        self.api.push("callback_query", {
+            "id": f"cb-{self.uid}-{self.sent}", "from": self._from(), "chat_instance": str(self.uid), "data": data,
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": self.uid, "type": "private"}},
+        })
+        self.sent += 1
+
+    async def step(self, name: str, action: Callable[[], None], expect: str, method: Optional[str] = None) -> None:
+        started = time.perf_counter()
+        action()
+        self._pos = await self.api.wait_for(
+            self.uid, self._pos, lambda m, t: (method is None or m == method) and expect in t,
+        )
+        self.step_times.setdefault(name, []).append(time.perf_counter() - started)
+
+    async def run(self) -> None:
+        await self.step("start", lambda: self.text("/start"), "Готов!")
+        await self.step("link", lambda: self.text(self.link), "Ищу заголовок")
+        await self.step("title", lambda: None, "Нашёл заголовок", "editMessageText")
+        await self.step("album", lambda: self.photos(self.album), f"Добавлено: {self.album}/9")
+        await self.step("media_done", lambda: self.press("media_done"), "Выбери категорию")
+        await self.step("category", lambda: self.press("cat:auto"), "Категория:", "editMessageText")
+        await self.step("tag", lambda: self.press("t:drone"), "", "editMessageReplyMarkup")
+        await self.step("tags_done", lambda: self.press("done"), "dir?")
+        await self.step("dir", lambda: self.text("Director Name"), "dop?")
+        await self.step("skip_dop", lambda: self.press("skip_dop"), "color?")
+        await self.step("color", lambda: self.text("Colorist Name"), "prod?")
+        await self.step("finalize", lambda: self.press("skip_prod"), "Пост в очереди")
+        await self.step("published", lambda: None, "Пост опубликован")
+
+# ---------- Отчёт ----------
+def exact_quantiles(values: List[float]) -> List[float]:
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(q * len(values)))] for q in QUANTILES]
+
+def fmt_ms(values: List[Optional[float]]) -> str:
+    return "  ".join("      —" if v is None else f"{v * 1000:7.1f}" for v in values)
+
+def report_histogram(title: str, name: str, label_keys: Tuple[str, ...]) -> None:
+    series = sorted(main.metrics.series(name), key=lambda l: tuple(l.get(k, "") for k in label_keys))
+    if not series:
+        return
+    print(f"\n{title} (мс, точно)")
+    print(f"  {'':34} {'p50':>7}  {'p95':>7}  {'p99':>7}")
+    for labels in series:
+        qs = exact_quantiles(main.metrics.samples(name, **labels))
+        print(f"  {'/'.join(labels.get(k, '') for k in label_keys):34} {fmt_ms(qs)}")
+
+def report(users: int, updates: int, elapsed: float, step_times: Dict[str, List[float]],
+           api: FakeBotApi, content: FakeContent, failed: int) -> None:
+    print(f"\nПользователей: {users} (не дошли до конца: {failed}), апдейтов: {updates}, за {elapsed:.2f} с")
+    print(f"Пропускная способность: {updates / elapsed:.1f} апдейтов/с, {(users - failed) / elapsed:.2f} постов/с")
+    print(f"Bot API: {sum(api.calls.values())} запросов, 429 подсунуто: {api.injected_429}, "
+          f"отклонено правок: {api.rejected_edits}; сайты: {content.hits}")
+    print(f"\nШаги пользователя, ответ бота (мс, точно)\n  {'':34} {'p50':>7}  {'p95':>7}  {'p99':>7}")
+    for name, values in step_times.items():
+        print(f"  {name:34} {fmt_ms(exact_quantiles(values))}")
+    for title, name, label_keys in HISTOGRAMS:
+        report_histogram(title, name, label_keys)
+
+# ---------- Запуск ----------
+async def start_site(app: web.Application) -> Tuple[web.AppRunner, int]:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner, runner.addresses[0][1]
+
+async def bench(args: argparse.Namespace) -> None:
+    api = FakeBotApi(args.api_latency, args.rate_429)
+    content = FakeContent(args.content_latency)
+    api_runner, api_port = await start_site(api.app())
+    content_runner, content_port = await start_site(content.app())
+    base = f"http://127.0.0.1:{content_port}"
+
+    # oEmbed-провайдер для поддельного видеохостинга; набор стратегий — из аргументов
+    main.OEMBED_PROVIDERS.append(((f"{base}/v/",), f"{base}/oembed", {}))
+    wanted = args.strategies.split(",")
+    main.TITLE_STRATEGIES[:] = [(n, fn) for n, fn in main.TITLE_STRATEGIES if n in wanted]
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{api_port}"))
+    bot = Bot(BENCH_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = main.build_dispatcher()
+    await main.start_services(bot)
+    polling = asyncio.ensure_future(dp.start_polling(bot, polling_timeout=1, handle_signals=False,
+                                                     close_bot_session=False))
+    step_times: Dict[str, List[float]] = {}
+    users = [
+        User(api, 10_000 + i, f"{base}/{'v' if i % 2 else 'page'}/{i}", args.album, step_times)
+        for i in range(args.users)
+    ]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(u.run() for u in users), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    failed = sum(isinstance(r, BaseException) for r in results)
+    for r in results:
+        if isinstance(r, BaseException):
+            print(f"user failed: {r!r}", file=sys.stderr)
+            break
+
+    await dp.stop_polling()
+    await asyncio.gather(polling, return_exceptions=True)
+    await main.update_limiter.drain()
+    await main.stop_services(bot)
+    await api_runner.cleanup()
+    await content_runner.cleanup()
+    report(args.users, sum(u.sent for u in users), elapsed, step_times, api, content, failed)
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк бота референсов.")
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--album", type=int, default=3, help="фото в альбоме каждого пользователя")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="задержка Bot API, сек.")
+    parser.add_argument("--content-latency", type=float, default=0.05, help="задержка сайтов, сек.")
+    parser.add_argument("--rate-429", type=float, default=0.1, help="доля sendMediaGroup, получающих 429")
+    parser.add_argument("--strategies", default="oembed,instagram,html", help="стратегии заголовка через запятую")
+    parser.add_argument("--real-limits", action="store_true", help="лимиты публикации как в проде")
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+if __name__ == "__main__":
+    cli()
@@ -7,28 +7,62 @@ Telegram Reference Bot — v7.1
 — Кредиты: dir / dop / color / prod (каждое поле можно пропустить)
 — Порядок подписи: Заголовок‑ссылка → кредиты → хэштеги (категория/теги) — без слова «Категории/теги»
 — Хэштеги: '-' автоматически меняется на '_'
+— Режим: long polling по умолчанию; WEBHOOK_BASE_URL (+ WEBHOOK_SECRET, PORT) — webhook на aiohttp;
+  процессу нужен входящий HTTP на PORT (Heroku: web-процесс в Procfile вместо worker)
+— Похожие картинки: dHash вложений (Pillow, необязателен) — предупреждение о повторе и /similar
+— Архив медиа: вложения постов скачиваются в фоне в ARCHIVE_DIR/ab/cd/<sha256> (одинаковые — один раз)
+— Метрики: METRICS_PORT — Prometheus /metrics на 127.0.0.1; PROFILE_SLOW_UPDATE — профили медленных апдейтов
+— Импорт таблиц: python main.py backfill links.csv|links.jsonl [--workers N] [--publish]
+— Переименовали категорию/тег: CATEGORY_RENAMES/TAG_RENAMES + python main.py recaption — подписи в канале пересоберутся
+— Выгрузка: python main.py export refs.jsonl|refs.csv; JSON API только на чтение: python main.py api [--port N]
 
 Зависимости:
-  pip install -U aiogram yt-dlp requests
+  pip install -U aiogram yt-dlp   (aiohttp приходит вместе с aiogram)
 """
 
+import argparse
 import asyncio
+import bisect
+import codecs
+import copy
+import csv
+import hashlib
+import io
 import json
+import logging
+import multiprocessing
 import os
+import queue
+import random
 import re
+import signal
 import sqlite3
+import sys
 import textwrap
-from contextlib import closing
-from datetime import datetime
-from typing import List, Optional, Dict, Literal
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
+from html import escape as html_escape
+from html.parser import HTMLParser
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
+from typing import Any, Awaitable, Callable, Iterator, List, Optional, Dict, Literal, Tuple
 
-import requests
-from aiogram import Bot, Dispatcher, F, Router
+import aiohttp
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     CallbackQuery,
     InlineKeyboardButton,
@@ -39,6 +73,10 @@ from aiogram.types import (
     InputMediaPhoto,
     InputMediaVideo,
     InputMediaAnimation,
+    InlineQuery,
+    InlineQueryResultCachedMpeg4Gif,
+    InlineQueryResultCachedPhoto,
+    InlineQueryResultCachedVideo,
 )
 
 # ---------- CONFIG ----------
@@ -60,6 +98,32 @@ def yt_dlp_meta_args() -> List[str]:
         args += ["--impersonate", YTDLP_IMPERSONATE]
     return args
 
+def yt_dlp_meta_opts() -> Dict:
+    """То же, что yt_dlp_meta_args, но опциями YoutubeDL (impersonate разбирается в воркере)."""
+    opts: Dict = {
+        "quiet": True,
+        "no_warnings": True,
+        "skip_download": True,
+        "socket_timeout": 10,
+        # Плейлист не разворачиваем: нужен только заголовок
+        "noplaylist": True,
+        "extract_flat": "in_playlist",
+        "lazy_playlist": True,
+        "playlistend": 1,
+    }
+    if YTDLP_COOKIES_FILE:
+        opts["cookiefile"] = YTDLP_COOKIES_FILE
+    elif YTDLP_BROWSER:
+        browser, _, profile = YTDLP_BROWSER.partition(":")
+        opts["cookiesfrombrowser"] = (browser, profile or None, None, None)
+    return opts
+
+# ---- YT-DLP POOL ----
+YTDLP_POOL_SIZE = int(os.getenv("YTDLP_POOL_SIZE", "2"))          # 0 — без пула, через CLI
+YTDLP_JOB_TIMEOUT = float(os.getenv("YTDLP_JOB_TIMEOUT", "20"))   # сек. на одну ссылку
+YTDLP_MAX_JOBS = int(os.getenv("YTDLP_MAX_JOBS", "200"))          # перезапуск воркера после N ссылок
+YTDLP_MAX_RSS_MB = int(os.getenv("YTDLP_MAX_RSS_MB", "400"))      # ... или при росте памяти
+
 # Категории (если нужно — пришлёшь новую матрицу, обновлю)
 CATEGORIES = [
     "fashion", "auto", "food", "beauty", "sport", "tech",
@@ -89,8 +153,295 @@ TAG_GROUPS: Dict[str, List[str]] = {
     ],
 }
 
+# Переименования: старое имя -> новое. recaption применяет их к refs и правит подписи в канале;
+# записи можно удалить, когда пересборка прошла до конца
+CATEGORY_RENAMES: Dict[str, str] = {}
+TAG_RENAMES: Dict[str, str] = {}
+
+# ---------- METRICS ----------
+log = logging.getLogger("refbot")
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))    # 0 — не поднимать; слушаем только 127.0.0.1
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # сек.
+PROFILE_SLOW_UPDATE = float(os.getenv("PROFILE_SLOW_UPDATE", "0"))  # сек.; > 0 — профилировать апдейты дольше
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))     # период сэмплирования, сек.
+PROFILE_DIR = "work/profiles"
+
+class Metrics:
+    """
+    Счётчики, gauge и гистограммы в памяти процесса (пишут и event loop, и поток БД — под замком).
+    render() — текстовый формат Prometheus; quantile() — оценка перцентиля по корзинам гистограммы.
+    keep_samples(name) — дополнительно хранить сырые значения гистограммы (бенчмарк: точные перцентили).
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = METRICS_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+        self._gauges: Dict[Tuple[str, Tuple], float] = {}
+        self._hists: Dict[Tuple[str, Tuple], List] = {}  # -> [счётчики по корзинам (+Inf последней), сумма]
+        self._sampled: set = set()
+        self._samples: Dict[Tuple[str, Tuple], List[float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Tuple]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+            if name in self._sampled:
+                self._samples.setdefault(key, []).append(value)
+
+    def keep_samples(self, *names: str) -> None:
+        with self._lock:
+            self._sampled.update(names)
+
+    def samples(self, name: str, **labels: Any) -> List[float]:
+        with self._lock:
+            return list(self._samples.get(self._key(name, labels), ()))
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any):
+        """Время блока -> гистограмма name; исключение -> ещё и счётчик <name без _seconds>_errors_total."""
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(name.replace("_seconds", "") + "_errors_total", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def quantile(self, name: str, q: float, **labels: Any) -> Optional[float]:
+        with self._lock:
+            h = self._hists.get(self._key(name, labels))
+            counts = list(h[0]) if h else []
+        total = sum(counts)
+        if not total:
+            return None
+        rank, seen = q * total, 0
+        for i, n in enumerate(counts):
+            if n and seen + n >= rank:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / n  # линейно внутри корзины
+            seen += n
+        return self.buckets[-1]
+
+    def series(self, name: str) -> List[Dict[str, str]]:
+        """Наборы меток, под которыми есть гистограмма name."""
+        with self._lock:
+            return [dict(labels) for n, labels in self._hists if n == name]
+
+    @staticmethod
+    def _labels(labels: Tuple, extra: str = "") -> str:
+        parts = ['%s="%s"' % (k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                 for k, v in labels]
+        if extra:
+            parts.append(extra)
+        return "{%s}" % ",".join(parts) if parts else ""
+
+    def render(self) -> str:
+        with self._lock:
+            counters, gauges = dict(self._counters), dict(self._gauges)
+            hists = {k: (list(h[0]), h[1]) for k, h in self._hists.items()}
+        out: List[str] = []
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({n for n, _ in values}):
+                out.append(f"# TYPE {name} {kind}")
+                out += [f"{name}{self._labels(l)} {v:g}" for (n, l), v in sorted(values.items()) if n == name]
+        for name in sorted({n for n, _ in hists}):
+            out.append(f"# TYPE {name} histogram")
+            for (n, l), (counts, total) in sorted(hists.items()):
+                if n != name:
+                    continue
+                acc = 0
+                for le, c in zip(list(self.buckets) + ["+Inf"], counts):
+                    acc += c
+                    le_label = 'le="%s"' % le
+                    out.append(f"{name}_bucket{self._labels(l, le_label)} {acc}")
+                out.append(f"{name}_sum{self._labels(l)} {total:g}")
+                out.append(f"{name}_count{self._labels(l)} {acc}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics()
+
+def _await_stack(task: asyncio.Task) -> List[str]:
+    """Цепочка await задачи от корня до текущей точки ожидания."""
+    frames = []
+    coro: Any = task.get_coro()
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return frames
+
+class SlowUpdateProfiler:
+    """
+    Сэмплирующий профайлер (включается PROFILE_SLOW_UPDATE > 0). Поток раз в PROFILE_INTERVAL снимает
+    для каждого апдейта в работе цепочку await его задачи (где он ждёт) и, если event loop не простаивает,
+    стек потока loop (на что уходит CPU). Апдейт дольше порога сохраняется в PROFILE_DIR в свёрнутом
+    формате (flamegraph.pl / speedscope), самые частые стеки — в лог.
+    """
+
+    def __init__(self, threshold: float = PROFILE_SLOW_UPDATE, interval: float = PROFILE_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self._active: Dict[asyncio.Task, Dict[str, int]] = {}
+        self._lock = threading.Lock()  # _active и его счётчики меняют и loop, и поток профайлера
+        self._loop_thread = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._thread is not None
+
+    def start(self) -> None:
+        if self.threshold <= 0 or self._thread is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def begin(self, task: asyncio.Task) -> None:
+        if self._thread is not None:
+            with self._lock:
+                self._active[task] = {}
+
+    def end(self, task: asyncio.Task, elapsed: float, label: str) -> None:
+        with self._lock:
+            samples = self._active.pop(task, None)
+        if samples and elapsed >= self.threshold:
+            self._dump(samples, elapsed, label)
+
+    def _loop_stack(self) -> Optional[str]:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None or frame.f_code.co_name in ("select", "poll", "_run_once"):
+            return None  # loop ждёт событий
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return "[cpu];" + ";".join(reversed(stack))
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            if not self._active:
+                continue
+            with self._lock:
+                tasks = list(self._active)
+            cpu = self._loop_stack()
+            stacks = []
+            for task in tasks:
+                try:
+                    stacks.append((task, ";".join(_await_stack(task))))
+                except Exception:
+                    continue  # задача поменялась под нами — пропускаем сэмпл
+            with self._lock:
+                for task, stack in stacks:
+                    samples = self._active.get(task)
+                    if samples is None:
+                        continue  # апдейт уже закончился и мог уйти в _dump
+                    for key in filter(None, (stack, cpu)):
+                        samples[key] = samples.get(key, 0) + 1
+
+    def _dump(self, samples: Dict[str, int], elapsed: float, label: str) -> None:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{label}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(f"{stack} {n}\n" for stack, n in samples.items())
+        top = sorted(samples.items(), key=lambda kv: -kv[1])[:3]
+        log.warning("slow update %s: %.2fs, profile %s; top: %s", label, elapsed, path,
+                    " | ".join(f"{n}× {stack.rsplit(';', 1)[-1]}" for stack, n in top))
+
+profiler = SlowUpdateProfiler()
+
+class UpdateTimer(BaseMiddleware):
+    """Время апдейта целиком (по типу) + профайлер медленных апдейтов."""
+
+    async def __call__(self, handler, event, data):
+        task = asyncio.current_task()
+        profiler.begin(task)
+        started = time.perf_counter()
+        kind = getattr(event, "event_type", type(event).__name__)
+        try:
+            with metrics.timer("refbot_update_seconds", type=kind):
+                return await handler(event, data)
+        finally:
+            profiler.end(task, time.perf_counter() - started, f"{kind}-{getattr(event, 'update_id', 0)}")
+
+class HandlerTimer(BaseMiddleware):
+    """Время каждого сработавшего хендлера (inner middleware: вызывается только для выбранного хендлера)."""
+
+    async def __call__(self, handler, event, data):
+        obj = data.get("handler")
+        name = getattr(getattr(obj, "callback", None), "__name__", "unknown")
+        with metrics.timer("refbot_handler_seconds", handler=name):
+            return await handler(event, data)
+
+class ApiTimer(BaseRequestMiddleware):
+    """Каждый вызов Bot API: время по методу, ошибки — по классу исключения."""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.inc("refbot_telegram_errors_total", method=name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("refbot_telegram_seconds", time.perf_counter() - started, method=name)
+
+update_timer = UpdateTimer()
+handler_timer = HandlerTimer()
+api_timer = ApiTimer()
+
+async def start_metrics_server(port: int = METRICS_PORT) -> Optional[web.AppRunner]:
+    """GET /metrics на 127.0.0.1:port (наружу — только через явный прокси)."""
+    if port <= 0:
+        return None
+
+    async def _metrics(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    log.info("metrics on http://127.0.0.1:%d/metrics", port)
+    return runner
+
 # ---------- DB ----------
-DB_PATH = "work/references.db"
+DB_PATH = os.getenv("DB_PATH", "work/references.db")
 SCHEMA_SQL = """
 CREATE TABLE IF NOT EXISTS refs (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -105,22 +456,445 @@ CREATE TABLE IF NOT EXISTS refs (
     channel_message_id INTEGER,
     media_json TEXT,            -- JSON list of {"type":"photo|video|animation", "file_id":"..."}
     created_at TEXT NOT NULL
-);
+)
 """
 
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "256"))  # заданий на одну транзакцию писателя
+DB_READERS = int(os.getenv("DB_READERS", "2"))          # потоков-читателей
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=67108864",
+)
+
+class Database:
+    """
+    Одно долгоживущее соединение-писатель (WAL) в отдельном потоке.
+    write()/submit() кладут задание fn(conn) в очередь; поток забирает всё накопившееся (до DB_BATCH_MAX)
+    и выполняет одной транзакцией, каждое задание — в своём SAVEPOINT.
+    await write(...) возвращается после COMMIT, поэтому следующее read() видит запись.
+    close() дописывает очередь до конца. open(readonly=True) — только читатели (mode=ro), для
+    export/api рядом с работающим ботом.
+    """
+
+    def __init__(self):
+        self.path = ""
+        self.readonly = False
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._readers: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()
+        self._reader_conns: List[sqlite3.Connection] = []
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.readonly:
+            conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True,
+                                   isolation_level=None, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            if not (self.readonly and pragma.startswith(("PRAGMA journal_mode", "PRAGMA synchronous"))):
+                conn.execute(pragma)
+        return conn
+
+    def open(self, path: str, readonly: bool = False) -> None:
+        if self._readers is not None:
+            return
+        self.path = path
+        self.readonly = readonly
+        if not readonly:
+            writer = self._connect()
+            self._thread = threading.Thread(target=self._run, args=(writer,), name="db-writer", daemon=True)
+            self._thread.start()
+        self._readers = ThreadPoolExecutor(DB_READERS, thread_name_prefix="db-reader")
+
+    # --- запись ---
+    def submit(self, fn: Callable[[sqlite3.Connection], Any]) -> Future:
+        """Поставить запись в очередь, не дожидаясь коммита."""
+        if self.readonly:
+            raise sqlite3.OperationalError("database is opened read-only")
+        fut: Future = Future()
+        self._queue.put((fn, fut))
+        return fut
+
+    async def write(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        with metrics.timer("refbot_db_seconds", op="write"):  # очередь + транзакция
+            return await asyncio.wrap_future(self.submit(fn))
+
+    def _run(self, conn: sqlite3.Connection) -> None:
+        stop = False
+        while not stop:
+            job = self._queue.get()
+            if job is None:
+                break
+            batch = [job]
+            while len(batch) < DB_BATCH_MAX:
+                try:
+                    job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                batch.append(job)
+            started = time.perf_counter()
+            self._run_batch(conn, batch)
+            metrics.observe("refbot_db_batch_seconds", time.perf_counter() - started)
+            metrics.inc("refbot_db_jobs_total", len(batch))
+        conn.execute("PRAGMA optimize")
+        conn.close()
+
+    @staticmethod
+    def _run_batch(conn: sqlite3.Connection, batch: List[Tuple[Callable, Future]]) -> None:
+        done: List[Tuple[Future, Any, Optional[BaseException]]] = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for fn, fut in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    res = fn(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    done.append((fut, None, e))
+                else:
+                    done.append((fut, res, None))
+                conn.execute("RELEASE job")
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            done = [(fut, None, e) for _, fut in batch]
+        for fut, res, exc in done:
+            if fut.set_running_or_notify_cancel():
+                if exc is None:
+                    fut.set_result(res)
+                else:
+                    fut.set_exception(exc)
+
+    # --- чтение ---
+    def _read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            self._reader_conns.append(conn)
+        return fn(conn)
+
+    async def read(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        with metrics.timer("refbot_db_seconds", op="read"):
+            return await asyncio.get_running_loop().run_in_executor(self._readers, self._read, fn)
+
+    async def close(self) -> None:
+        if self._readers is None:
+            return
+        if self._thread is not None:
+            self._queue.put(None)
+            await asyncio.to_thread(self._thread.join)
+            self._thread = None
+        self._readers.shutdown(wait=True)
+        self._readers = None
+        for conn in self._reader_conns:
+            conn.close()
+        self._reader_conns.clear()
+
+db = Database()
+
+# ---- Теги: реестр битов ----
+# Бит закрепляется за тегом навсегда (новые теги получают следующий свободный), поэтому маска
+# в старых строках не портится при изменении TAG_GROUPS. Теги сверх 63 живут только в ref_tags.
+TAG_MASK_BITS = 63
+TAG_BITS: Dict[str, Optional[int]] = {}
+
+def parse_tags(raw: Optional[str]) -> List[str]:
+    """refs.tags ('a,b,c') -> список без пустых и дублей."""
+    return list(dict.fromkeys(t.strip() for t in (raw or "").split(",") if t.strip()))
+
+def sync_tag_bits(conn: sqlite3.Connection, extra: Tuple[str, ...] = ()) -> Dict[str, Optional[int]]:
+    """Добавляет в tag_bits теги из TAG_GROUPS (+ extra) и обновляет TAG_BITS."""
+    bits: Dict[str, Optional[int]] = dict(conn.execute("SELECT tag, bit FROM tag_bits"))
+    next_bit = max((b for b in bits.values() if b is not None), default=-1) + 1
+    for tag in [t for group in TAG_GROUPS.values() for t in group] + list(extra):
+        if tag in bits:
+            continue
+        bit = next_bit if next_bit < TAG_MASK_BITS else None
+        if bit is not None:
+            next_bit += 1
+        conn.execute("INSERT INTO tag_bits(tag, bit) VALUES (?,?)", (tag, bit))
+        bits[tag] = bit
+    TAG_BITS.update(bits)
+    return bits
+
+def tags_mask(tags: List[str]) -> int:
+    mask = 0
+    for t in tags:
+        bit = TAG_BITS.get(t)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+def _store_ref_tags(conn: sqlite3.Connection, ref_id: int, tags: List[str]) -> None:
+    missing = tuple(t for t in tags if t not in TAG_BITS)
+    if missing:
+        sync_tag_bits(conn, missing)
+    conn.executemany("INSERT OR IGNORE INTO ref_tags(tag, ref_id) VALUES (?,?)", [(t, ref_id) for t in tags])
+    conn.execute("UPDATE refs SET tag_mask=? WHERE id=?", (tags_mask(tags), ref_id))
+
+def _backfill_ref_tags(conn: sqlite3.Connection) -> None:
+    sync_tag_bits(conn)
+    for ref_id, raw in conn.execute("SELECT id, tags FROM refs WHERE tags IS NOT NULL AND tags != ''").fetchall():
+        _store_ref_tags(conn, ref_id, parse_tags(raw))
+
+# ---- Миграции: PRAGMA user_version = число применённых шагов ----
+def _migrate_legacy_columns(conn: sqlite3.Connection) -> None:
+    """Колонки, которых нет в базах старых версий бота."""
+    have = {row[1] for row in conn.execute("PRAGMA table_info(refs)")}
+    for col in ("dir", "dop", "color", "prod", "media_json"):
+        if col not in have:
+            conn.execute(f"ALTER TABLE refs ADD COLUMN {col} TEXT")
+
+def _backfill_caption_hashes(conn: sqlite3.Connection) -> None:
+    """Для постов из очереди публикации известна ровно отправленная подпись."""
+    conn.execute("ALTER TABLE refs ADD COLUMN caption_hash TEXT")
+    rows = conn.execute("SELECT ref_id, payload FROM publish_jobs WHERE status='done' AND error IS NULL").fetchall()
+    conn.executemany(
+        "UPDATE refs SET caption_hash=? WHERE id=?",
+        [(caption_hash(json.loads(payload)["caption"]), ref_id) for ref_id, payload in rows if ref_id],
+    )
+
+def seed_caption_hashes(conn: sqlite3.Connection) -> int:
+    """
+    caption_hash для постов, где он неизвестен (опубликованы до очереди): считаем, что в канале подпись,
+    собранная из строки refs как есть. Вызывать до apply_renames — иначе переименование примется за «уже так».
+    """
+    rows = conn.execute(
+        "SELECT id, title, source_url, category, tags, dir, dop, color, prod FROM refs "
+        "WHERE caption_hash IS NULL AND channel_message_id IS NOT NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE refs SET caption_hash=? WHERE id=?",
+        [(caption_hash(ref_caption(*row[1:])), row[0]) for row in rows],
+    )
+    return len(rows)
+
+def _seed_media_archive(conn: sqlite3.Connection) -> None:
+    """Вложения уже опубликованных постов — в очередь архива."""
+    for ref_id, media_json in conn.execute("SELECT id, media_json FROM refs WHERE channel_message_id IS NOT NULL").fetchall():
+        _queue_media_archive(conn, ref_id, json.loads(media_json or "[]"))
+
+def _backfill_canonical_urls(conn: sqlite3.Connection) -> None:
+    """Ключ дубля для старых строк; повтор того же ролика остаётся с NULL (первый пост — канонический)."""
+    have = {row[1] for row in conn.execute("PRAGMA table_info(refs)")}
+    if "canonical_url" not in have:
+        conn.execute("ALTER TABLE refs ADD COLUMN canonical_url TEXT")
+    seen = set()
+    updates = []
+    for ref_id, url in conn.execute("SELECT id, source_url FROM refs ORDER BY id").fetchall():
+        key = canonical_url(url or "") if url else None
+        if key in seen:
+            key = None
+        elif key is not None:
+            seen.add(key)
+        updates.append((key, ref_id))
+    conn.executemany("UPDATE refs SET canonical_url=? WHERE id=?", updates)
+
+# Только дописывать в конец: номер шага = его позиция в списке
+MIGRATIONS: List[Tuple] = [
+    # 1: базовая схема + мягкие миграции со старых версий
+    (SCHEMA_SQL, _migrate_legacy_columns),
+    # 2: кэш заголовков по каноническому URL (title='' — негативная запись)
+    (
+        """CREATE TABLE IF NOT EXISTS title_cache (
+            url TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            strategy TEXT,
+            fetched_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS title_cache_fetched_at ON title_cache(fetched_at)",
+    ),
+    # 3: индексы для поиска по архиву
+    (
+        "CREATE INDEX IF NOT EXISTS refs_source_url ON refs(source_url)",
+        "CREATE INDEX IF NOT EXISTS refs_category ON refs(category)",
+        "CREATE INDEX IF NOT EXISTS refs_created_at ON refs(created_at)",
+        "CREATE INDEX IF NOT EXISTS refs_channel_message_id ON refs(channel_message_id)",
+    ),
+    # 4: полнотекстовый индекс по архиву, синхронизируется триггерами
+    (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS refs_fts USING fts5(
+            title, dir, dop, color, prod, category, tags,
+            content='refs', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS refs_fts_ai AFTER INSERT ON refs BEGIN
+            INSERT INTO refs_fts(rowid, title, dir, dop, color, prod, category, tags)
+            VALUES (new.id, new.title, new.dir, new.dop, new.color, new.prod, new.category, new.tags);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS refs_fts_ad AFTER DELETE ON refs BEGIN
+            INSERT INTO refs_fts(refs_fts, rowid, title, dir, dop, color, prod, category, tags)
+            VALUES ('delete', old.id, old.title, old.dir, old.dop, old.color, old.prod, old.category, old.tags);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS refs_fts_au AFTER UPDATE OF title, dir, dop, color, prod, category, tags ON refs BEGIN
+            INSERT INTO refs_fts(refs_fts, rowid, title, dir, dop, color, prod, category, tags)
+            VALUES ('delete', old.id, old.title, old.dir, old.dop, old.color, old.prod, old.category, old.tags);
+            INSERT INTO refs_fts(rowid, title, dir, dop, color, prod, category, tags)
+            VALUES (new.id, new.title, new.dir, new.dop, new.color, new.prod, new.category, new.tags);
+        END""",
+        # Заголовок весомее кредитов, кредиты — весомее категории/тегов
+        "INSERT INTO refs_fts(refs_fts, rank) VALUES ('rank', 'bm25(5.0, 2.0, 2.0, 2.0, 2.0, 1.0, 1.0)')",
+        "INSERT INTO refs_fts(refs_fts) VALUES ('rebuild')",
+    ),
+    # 5: префиксные индексы FTS для inline-поиска по первым буквам (триггеры из шага 4 остаются)
+    (
+        "DROP TABLE IF EXISTS refs_fts",
+        """CREATE VIRTUAL TABLE refs_fts USING fts5(
+            title, dir, dop, color, prod, category, tags,
+            content='refs', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )""",
+        "INSERT INTO refs_fts(refs_fts, rank) VALUES ('rank', 'bm25(5.0, 2.0, 2.0, 2.0, 2.0, 1.0, 1.0)')",
+        "INSERT INTO refs_fts(refs_fts) VALUES ('rebuild')",
+    ),
+    # 6: нормализованные теги: реестр битов, связка ref_tags и битовая маска в refs
+    (
+        "CREATE TABLE IF NOT EXISTS tag_bits (tag TEXT PRIMARY KEY, bit INTEGER UNIQUE)",
+        """CREATE TABLE IF NOT EXISTS ref_tags (
+            tag TEXT NOT NULL,
+            ref_id INTEGER NOT NULL,
+            PRIMARY KEY (tag, ref_id)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS ref_tags_ref ON ref_tags(ref_id, tag)",
+        "ALTER TABLE refs ADD COLUMN tag_mask INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS refs_category_mask ON refs(category, tag_mask, id)",
+        "DROP INDEX IF EXISTS refs_category",  # перекрыт refs_category_mask
+        "CREATE INDEX IF NOT EXISTS refs_tag_mask ON refs(tag_mask, id)",
+        _backfill_ref_tags,
+    ),
+    # 7: FSM-сессии (SQLiteStorage)
+    (
+        """CREATE TABLE IF NOT EXISTS fsm_sessions (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS fsm_sessions_updated_at ON fsm_sessions(updated_at)",
+    ),
+    # 8: очередь публикации в канал
+    (
+        """CREATE TABLE IF NOT EXISTS publish_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,               -- куда публикуем
+            reply_chat_id INTEGER,               -- кому сообщить результат
+            payload TEXT NOT NULL,               -- JSON: caption, media, ref (поля для refs)
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | sending | done | failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_at REAL NOT NULL,
+            ref_id INTEGER,
+            error TEXT,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS publish_jobs_due ON publish_jobs(status, next_at)",
+    ),
+    # 9: канонический URL для поиска дублей; ключи title_cache считались по-старому — сбрасываем
+    (
+        _backfill_canonical_urls,
+        "CREATE UNIQUE INDEX IF NOT EXISTS refs_canonical_url ON refs(canonical_url)",
+        "DELETE FROM title_cache",
+    ),
+    # 10: checkpoint'ы обслуживающих команд (backfill и т.п.)
+    (
+        """CREATE TABLE IF NOT EXISTS job_state (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL,                 -- JSON
+            updated_at REAL NOT NULL
+        )""",
+    ),
+    # 11: статистика стратегий заголовка по доменам (StrategyRouter)
+    (
+        """CREATE TABLE IF NOT EXISTS strategy_stats (
+            domain TEXT NOT NULL,
+            strategy TEXT NOT NULL,
+            ok REAL NOT NULL,                    -- затухающие счётчики
+            fail REAL NOT NULL,
+            latencies TEXT NOT NULL,             -- JSON: последние задержки, сек.
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (domain, strategy)
+        ) WITHOUT ROWID""",
+    ),
+    # 12: перцептивные хэши картинок (ImageIndex); h0..h3 — 16-битные куски для multi-index hashing
+    (
+        """CREATE TABLE IF NOT EXISTS image_hashes (
+            file_unique_id TEXT PRIMARY KEY,     -- то, что хэшировали (фото или превью видео/GIF)
+            media_file_id TEXT,                  -- file_id вложения в media_json
+            hash INTEGER NOT NULL,               -- dHash, 64 бита (со знаком, как хранит SQLite)
+            h0 INTEGER NOT NULL,
+            h1 INTEGER NOT NULL,
+            h2 INTEGER NOT NULL,
+            h3 INTEGER NOT NULL,
+            ref_id INTEGER,                      -- NULL — ещё не опубликовано
+            created_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS image_hashes_h0 ON image_hashes(h0)",
+        "CREATE INDEX IF NOT EXISTS image_hashes_h1 ON image_hashes(h1)",
+        "CREATE INDEX IF NOT EXISTS image_hashes_h2 ON image_hashes(h2)",
+        "CREATE INDEX IF NOT EXISTS image_hashes_h3 ON image_hashes(h3)",
+        "CREATE INDEX IF NOT EXISTS image_hashes_media ON image_hashes(media_file_id)",
+        "CREATE INDEX IF NOT EXISTS image_hashes_ref ON image_hashes(ref_id)",
+    ),
+    # 13: хэш подписи, с которой пост сейчас в канале (recaption пропускает неизменившиеся)
+    (_backfill_caption_hashes,),
+    # 14: локальный архив медиа: файлы по SHA-256 + очередь/соответствие file_id -> файл (MediaArchive)
+    (
+        """CREATE TABLE IF NOT EXISTS media_files (
+            sha256 TEXT PRIMARY KEY,             -- имя файла в ARCHIVE_DIR/ab/cd/<sha256>
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL
+        ) WITHOUT ROWID""",
+        """CREATE TABLE IF NOT EXISTS media_archive (
+            file_id TEXT PRIMARY KEY,            -- как в refs.media_json
+            ref_id INTEGER,
+            kind TEXT,                           -- photo | video | animation
+            file_unique_id TEXT,                 -- известен после getFile
+            sha256 TEXT,                         -- -> media_files
+            status TEXT NOT NULL DEFAULT 'pending',  -- pending | downloading | done | failed
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_at REAL NOT NULL,
+            error TEXT,
+            updated_at REAL NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS media_archive_due ON media_archive(status, next_at)",
+        "CREATE INDEX IF NOT EXISTS media_archive_unique ON media_archive(file_unique_id)",
+        "CREATE INDEX IF NOT EXISTS media_archive_ref ON media_archive(ref_id)",
+        _seed_media_archive,
+    ),
+    # 15: общая статистика '*' копила промахи oEmbed/Instagram на чужих сайтах — больше не используется
+    ("DELETE FROM strategy_stats WHERE domain = '*'",),
+    # 16: хэши подписей постов, вышедших до очереди публикации (шаг 13 брал только задания очереди)
+    (seed_caption_hashes,),
+]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Применяет недостающие шаги MIGRATIONS (выполняется в транзакции писателя целиком)."""
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for steps in MIGRATIONS[current:]:
+        for step in steps:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(step)
+    if current < len(MIGRATIONS):
+        conn.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+    return len(MIGRATIONS)
+
 def init_db():
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        conn.execute(SCHEMA_SQL)
-        # Мягкие миграции со старых версий
-        for new_col in ("dir", "dop", "color", "prod", "media_json"):
-            try:
-                conn.execute(f"ALTER TABLE refs ADD COLUMN {new_col} TEXT")
-            except sqlite3.OperationalError:
-                pass
-        conn.commit()
+    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+    db.open(DB_PATH)
+    db.submit(migrate).result()
+    db.submit(sync_tag_bits).result()
+    db.submit(strategy_router.load).result()
 
-def insert_reference(
+def _insert_reference(
+    conn: sqlite3.Connection,
     source_url: str,
     title: str,
     category: str,
@@ -132,27 +906,243 @@ def insert_reference(
     color: str = "",
     prod: str = "",
 ) -> int:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO refs(source_url,title,category,tags,dir,dop,color,prod,channel_message_id,media_json,created_at) "
-            "VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-            (
-                source_url,
-                title,
-                category,
-                ",".join(tags),
-                dir_,
-                dop,
-                color,
-                prod,
-                channel_message_id,
-                json.dumps(media),
-                datetime.utcnow().isoformat(),
-            ),
-        )
-        conn.commit()
-        return cur.lastrowid
+    """Вставка поста внутри транзакции писателя (refs + ref_tags/маска)."""
+    row = (
+        source_url,
+        title,
+        category,
+        ",".join(tags),
+        dir_,
+        dop,
+        color,
+        prod,
+        channel_message_id,
+        json.dumps(media),
+        datetime.utcnow().isoformat(),
+    )
+    sql = (
+        "INSERT INTO refs(source_url,title,category,tags,dir,dop,color,prod,channel_message_id,media_json,created_at,"
+        "canonical_url) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
+    )
+    try:
+        cur = conn.execute(sql, row + (canonical_url(source_url) if source_url else None,))
+    except sqlite3.IntegrityError:
+        # пост уже вышел, а такой URL есть в архиве (гонка) — сохраняем без ключа дубля
+        cur = conn.execute(sql, row + (None,))
+    _store_ref_tags(conn, cur.lastrowid, tags)
+    _link_image_hashes(conn, cur.lastrowid, media)
+    if channel_message_id is not None:
+        _queue_media_archive(conn, cur.lastrowid, media)
+    return cur.lastrowid
+
+async def insert_reference(
+    source_url: str,
+    title: str,
+    category: str,
+    tags: List[str],
+    media: List[Dict[str, str]],
+    channel_message_id: Optional[int],
+    dir_: str = "",
+    dop: str = "",
+    color: str = "",
+    prod: str = "",
+) -> int:
+    return await db.write(lambda conn: _insert_reference(
+        conn, source_url, title, category, tags, media, channel_message_id, dir_, dop, color, prod,
+    ))
+
+def load_checkpoint(conn: sqlite3.Connection, name: str) -> Optional[Dict[str, Any]]:
+    row = conn.execute("SELECT state FROM job_state WHERE name=?", (name,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_checkpoint(conn: sqlite3.Connection, name: str, state: Dict[str, Any]) -> None:
+    """Пишется в той же транзакции, что и сделанная работа, — после падения продолжаем ровно с него."""
+    conn.execute(
+        "INSERT INTO job_state(name, state, updated_at) VALUES (?,?,?) "
+        "ON CONFLICT(name) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+        (name, json.dumps(state), time.time()),
+    )
+
+async def find_ref_by_url(url: str) -> Optional[Tuple[int, Optional[int]]]:
+    """(id, channel_message_id) поста с тем же каноническим URL — поиск по уникальному индексу."""
+    if not url:
+        return None
+    key = canonical_url(url)
+    return await db.read(lambda conn: conn.execute(
+        "SELECT id, channel_message_id FROM refs WHERE canonical_url=?", (key,),
+    ).fetchone())
+
+def duplicate_note(ref: Tuple[int, Optional[int]]) -> str:
+    post = channel_post_link(ref[1])
+    return f"Эта ссылка уже есть в канале: {post}" if post else f"Эта ссылка уже есть в архиве (запись #{ref[0]})."
+
+# ---- Поиск по архиву (FTS5 + маска тегов) ----
+SEARCH_PAGE = int(os.getenv("SEARCH_PAGE", "5"))
+
+def _hashtag_key(name: str) -> str:
+    return name.strip().lstrip("#").replace("-", "_").lower()
+
+def split_query(text: str) -> Tuple[str, List[str], List[List[str]], Optional[str]]:
+    """
+    Запрос -> (текст для FTS, теги И, группы тегов ИЛИ, категория).
+    '#slowmo #drone' — оба тега, '#slowmo|drone' — любой из, '#auto' — категория.
+    Неизвестные/неоднозначные хэштеги остаются в тексте (FTS по category/tags).
+    """
+    tag_by_key = {_hashtag_key(t): t for t in TAG_BITS}
+    cat_by_key = {_hashtag_key(c): c for c in CATEGORIES}
+    words: List[str] = []
+    all_tags: List[str] = []
+    any_groups: List[List[str]] = []
+    category: Optional[str] = None
+    for word in text.split():
+        if word.startswith("#"):
+            keys = [_hashtag_key(k) for k in word.split("|")]
+            if len(keys) == 1 and category is None and keys[0] in cat_by_key and keys[0] not in tag_by_key:
+                category = cat_by_key[keys[0]]
+                continue
+            if all(k in tag_by_key and k not in cat_by_key for k in keys):
+                names = [tag_by_key[k] for k in keys]
+                if len(names) == 1:
+                    all_tags.append(names[0])
+                else:
+                    any_groups.append(names)
+                continue
+        words.append(word)
+    return " ".join(words), all_tags, any_groups, category
+
+def fts_query(text: str) -> str:
+    """
+    Текст пользователя -> запрос FTS5: каждое слово — фраза с префиксным поиском, все через AND.
+    '#tag' ищется только по категории/тегам и целиком.
+    """
+    parts = []
+    for word in text.split():
+        is_tag = word.startswith("#")
+        term = word.lstrip("#").replace('"', '""')
+        if not term.strip('"'):
+            continue
+        parts.append(f'{{category tags}} : "{term}"' if is_tag else f'"{term}"*')
+    return " AND ".join(parts)
+
+def tag_filter_sql(all_tags: List[str], any_groups: List[List[str]]) -> Tuple[List[str], List[Any]]:
+    """
+    Условия по тегам: через маску (побитовая проверка по индексам refs_tag_mask / refs_category_mask),
+    для тегов без бита — EXISTS по ref_tags.
+    """
+    where: List[str] = []
+    args: List[Any] = []
+    mask = tags_mask(all_tags)
+    if mask:
+        where.append("(r.tag_mask & ?) = ?")
+        args += [mask, mask]
+    for t in all_tags:
+        if TAG_BITS.get(t) is None:
+            where.append("EXISTS (SELECT 1 FROM ref_tags rt WHERE rt.tag = ? AND rt.ref_id = r.id)")
+            args.append(t)
+    for group in any_groups:
+        if all(TAG_BITS.get(t) is not None for t in group):
+            where.append("(r.tag_mask & ?) != 0")
+            args.append(tags_mask(group))
+        else:
+            marks = ",".join("?" * len(group))
+            where.append(f"EXISTS (SELECT 1 FROM ref_tags rt WHERE rt.tag IN ({marks}) AND rt.ref_id = r.id)")
+            args += group
+    return where, args
+
+def archive_query(
+    columns: str,
+    text: str,
+    after: Optional[Tuple[float, int]],
+    limit: int,
+    media_only: bool = False,
+) -> Tuple[str, List[Any]]:
+    """
+    SELECT {columns}, rank по архиву. С текстом — FTS по релевантности (rank = bm25),
+    только теги/категория — свежие первыми (rank = -id). Ключ пагинации — (rank, id) последней строки.
+    """
+    words, all_tags, any_groups, category = split_query(text)
+    fts = fts_query(words)
+    where: List[str] = []
+    args: List[Any] = []
+    if fts:
+        source, rank, order = "refs_fts f JOIN refs r ON r.id = f.rowid", "f.rank", "f.rank, f.rowid"
+        where.append("refs_fts MATCH ?")
+        args.append(fts)
+        if after is not None:
+            where.append("(f.rank > ? OR (f.rank = ? AND f.rowid > ?))")
+            args += [after[0], after[0], after[1]]
+    else:
+        source, rank, order = "refs r", "-r.id", "r.id DESC"
+        if after is not None:
+            where.append("r.id < ?")
+            args.append(after[1])
+    if category:
+        where.append("r.category = ?")
+        args.append(category)
+    tag_where, tag_args = tag_filter_sql(all_tags, any_groups)
+    where += tag_where
+    args += tag_args
+    if media_only:
+        where.append("r.media_json LIKE '[{%'")
+    sql = f"SELECT {columns}, {rank} FROM {source}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += f" ORDER BY {order} LIMIT ?"
+    args.append(limit)
+    return sql, args
+
+async def search_refs(
+    text: str,
+    after: Optional[Tuple[float, int]] = None,
+    limit: int = SEARCH_PAGE,
+) -> List[Tuple]:
+    """
+    (id, title, source_url, category, channel_message_id, rank) по релевантности.
+    Пагинация по ключу (rank, id) последней строки предыдущей страницы — без OFFSET.
+    """
+    if not text.split():
+        return []
+    sql, args = archive_query("r.id, r.title, r.source_url, r.category, r.channel_message_id", text, after, limit)
+    return await db.read(lambda conn: conn.execute(sql, args).fetchall())
+
+REF_CARD_COLUMNS = "r.id, r.title, r.source_url, r.category, r.tags, r.dir, r.dop, r.color, r.prod, r.media_json"
+
+async def inline_search(text: str, offset: str, limit: int) -> Tuple[List[Tuple], str]:
+    """
+    Поиск для inline-режима: строки REF_CARD_COLUMNS + rank и next_offset ('rank:id').
+    Пустой запрос — свежие посты.
+    """
+    after = None
+    if offset:
+        rank, ref_id = offset.rsplit(":", 1)
+        after = (float(rank), int(ref_id))
+    sql, args = archive_query(REF_CARD_COLUMNS, text, after, limit + 1, media_only=True)
+    rows = await db.read(lambda conn: conn.execute(sql, args).fetchall())
+    next_offset = ""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_offset = f"{last[-1]!r}:{last[0]}"
+    return rows, next_offset
+
+async def find_refs_by_tags(
+    all_of: List[str] = (),
+    any_of: List[str] = (),
+    category: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = 50,
+) -> List[int]:
+    """id постов (свежие первыми) со всеми all_of и хотя бы одним из any_of — через маску/ref_tags."""
+    where, args = tag_filter_sql(list(all_of), [list(any_of)] if any_of else [])
+    if category:
+        where.append("r.category = ?")
+        args.append(category)
+    if before_id is not None:
+        where.append("r.id < ?")
+        args.append(before_id)
+    sql = "SELECT r.id FROM refs r" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY r.id DESC LIMIT ?"
+    args.append(limit)
+    return await db.read(lambda conn: [row[0] for row in conn.execute(sql, args)])
 
 # ---------- FSM ----------
 class AddFlow(StatesGroup):
@@ -165,6 +1155,151 @@ class AddFlow(StatesGroup):
     entering_color = State()
     entering_prod = State()
 
+# ---------- FSM STORAGE ----------
+FSM_SESSION_TTL = float(os.getenv("FSM_SESSION_TTL", str(3 * 24 * 3600)))  # сессия без активности удаляется
+FSM_HOT_SIZE = int(os.getenv("FSM_HOT_SIZE", "1000"))                      # сессий в памяти (LRU)
+FSM_FLUSH_DELAY = float(os.getenv("FSM_FLUSH_DELAY", "0.05"))              # окно склейки записей, сек.
+FSM_SWEEP_EVERY = float(os.getenv("FSM_SWEEP_EVERY", "600"))               # период чистки, сек.
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в references.db: сессии AddFlow переживают рестарт.
+    Горячие сессии — в LRU в памяти; изменения помечают ключ грязным, и все изменения за окно
+    FSM_FLUSH_DELAY уходят в БД одной транзакцией. Фоновый чистильщик удаляет сессии старше FSM_SESSION_TTL.
+    """
+
+    def __init__(self, hot_size: int = FSM_HOT_SIZE, ttl: float = FSM_SESSION_TTL):
+        self.hot_size = hot_size
+        self.ttl = ttl
+        # key -> [state, data, updated_at]
+        self._hot: "OrderedDict[str, List]" = OrderedDict()
+        self._dirty: set = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._sweeper: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(part) for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny,
+        ))
+
+    async def _record(self, key: StorageKey) -> Tuple[str, List]:
+        k = self._key(key)
+        rec = self._hot.get(k)
+        if rec is None:
+            row = await db.read(lambda conn: conn.execute(
+                "SELECT state, data, updated_at FROM fsm_sessions WHERE key=?", (k,),
+            ).fetchone())
+            rec = self._hot.get(k)  # пока читали, запись могла появиться
+            if rec is None:
+                rec = [row[0], json.loads(row[1]), row[2]] if row else [None, {}, time.time()]
+                self._hot[k] = rec
+                self._evict(keep=k)
+        self._hot.move_to_end(k)
+        return k, rec
+
+    def _evict(self, keep: str = "") -> None:
+        extra = len(self._hot) - self.hot_size
+        for k in list(self._hot):
+            if extra <= 0:
+                break
+            if k != keep and k not in self._dirty:  # грязные уйдут после ближайшего flush
+                del self._hot[k]
+                extra -= 1
+
+    def _touch(self, k: str, rec: List) -> None:
+        rec[2] = time.time()
+        self._dirty.add(k)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(FSM_FLUSH_DELAY)
+        try:
+            await self.flush()
+        except Exception:
+            # ключи вернулись в _dirty: их допишет следующий _touch или close()
+            log.exception("FSM flush failed, %d sessions stay dirty", len(self._dirty))
+
+    async def flush(self) -> None:
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for k in keys:
+            rec = self._hot.get(k)
+            if rec is None:
+                continue
+            state, data, updated_at = rec
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+
+        def _write(conn: sqlite3.Connection) -> None:
+            conn.executemany("INSERT OR REPLACE INTO fsm_sessions(key, state, data, updated_at) VALUES (?,?,?,?)", upserts)
+            conn.executemany("DELETE FROM fsm_sessions WHERE key=?", deletes)
+
+        try:
+            await db.write(_write)
+        except BaseException:
+            self._dirty |= keys  # изменения не теряем — запишутся следующим flush
+            raise
+        self._evict()
+
+    async def sweep(self) -> int:
+        """Удаляет сессии без активности дольше ttl (и из памяти, и из БД)."""
+        cutoff = time.time() - self.ttl
+        for k, rec in list(self._hot.items()):
+            if rec[2] < cutoff and k not in self._dirty:
+                del self._hot[k]
+        return await db.write(lambda conn: conn.execute(
+            "DELETE FROM fsm_sessions WHERE updated_at < ?", (cutoff,),
+        ).rowcount)
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            await asyncio.sleep(FSM_SWEEP_EVERY)
+            await self.sweep()
+
+    def start(self) -> None:
+        if self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    # --- BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, rec = await self._record(key)
+        rec[0] = state.state if isinstance(state, State) else state
+        self._touch(k, rec)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, rec = await self._record(key)
+        return rec[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k, rec = await self._record(key)
+        rec[1] = copy.deepcopy(data)
+        self._touch(k, rec)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, rec = await self._record(key)
+        return copy.deepcopy(rec[1])
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        # Без await между чтением и записью — параллельные апдейты одной сессии не затирают друг друга
+        k, rec = await self._record(key)
+        rec[1].update(copy.deepcopy(data))
+        self._touch(k, rec)
+        return copy.deepcopy(rec[1])
+
+    async def close(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self.flush()
+
+fsm_storage = SQLiteStorage()
+
 # ---------- HELPERS ----------
 LINK_RE = re.compile(r"https?://\S+")
 
@@ -211,82 +1346,1371 @@ def hashtags(category: str, tags: List[str]) -> str:
         parts.append(f"#{t.strip().replace('-', '_')}")
     return " ".join(parts)
 
+# Трекинговые параметры, которые не влияют на контент
+TRACKING_PARAMS = {"igshid", "igsh", "si", "feature", "fbclid", "gclid", "ref", "ref_src", "share_id"}
+
+YOUTUBE_HOSTS = {"youtube.com", "music.youtube.com", "youtube-nocookie.com", "youtu.be"}
+VIMEO_HOSTS = {"vimeo.com", "player.vimeo.com"}
+INSTAGRAM_HOSTS = {"instagram.com", "instagr.am"}
+_YT_ID = r"([\w-]{11})"
+_YT_PATH_RE = re.compile(r"^/(?:shorts|embed|live|v|e)/" + _YT_ID)
+_VIMEO_PATH_RE = re.compile(r"^/(?:video/|channels/[^/]+/|groups/[^/]+/videos/|album/\d+/video/)?(\d+)")
+_IG_PATH_RE = re.compile(r"^/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)")
+
+def _video_page_url(host: str, path: str, query: str) -> Optional[str]:
+    """YouTube / Vimeo / Instagram: одна форма URL на ролик, независимо от вида ссылки."""
+    if host in YOUTUBE_HOSTS:
+        if host == "youtu.be":
+            m = re.match(r"^/" + _YT_ID, path)
+            video_id = m.group(1) if m else None
+        else:
+            m = _YT_PATH_RE.match(path)
+            video_id = m.group(1) if m else dict(parse_qsl(query)).get("v")
+        return f"https://youtube.com/watch?v={video_id}" if video_id else None
+    if host in VIMEO_HOSTS:
+        m = _VIMEO_PATH_RE.match(path)
+        return f"https://vimeo.com/{m.group(1)}" if m else None
+    if host in INSTAGRAM_HOSTS:
+        m = _IG_PATH_RE.match(path)
+        return f"https://instagram.com/p/{m.group(1)}" if m else None  # reel/p/tv — общий shortcode
+    return None
+
+def bare_host(hostname: Optional[str]) -> str:
+    host = (hostname or "").lower()
+    for prefix in ("www.", "m."):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    return host
+
+def url_host(url: str) -> str:
+    """bare_host() ссылки; '' для битого URL (urlsplit падает на 'http://[abc/')."""
+    try:
+        return bare_host(urlsplit(url).hostname)
+    except ValueError:
+        return ""
+
+def canonical_url(url: str) -> str:
+    """
+    Ключ для кэша и поиска дублей: https, хост без www./m., без фрагмента и трекинговых параметров,
+    query отсортирован. Ролики YouTube/Vimeo/Instagram сводятся к id (youtu.be/X, shorts/X, watch?v=X — одно).
+    Битый URL (порт вне диапазона, незакрытый '[') — ключ он сам, без пробелов по краям.
+    """
+    try:
+        p = urlsplit(url.strip())
+        port = p.port
+    except ValueError:
+        return url.strip()
+    host = bare_host(p.hostname)
+    video = _video_page_url(host, p.path, p.query)
+    if video:
+        return video
+    if port and port not in (80, 443):
+        host = f"{host}:{port}"
+    query = sorted(
+        (k, v) for k, v in parse_qsl(p.query, keep_blank_values=True)
+        if not (k.lower().startswith("utm_") or k.lower() in TRACKING_PARAMS)
+    )
+    path = p.path.rstrip("/") or "/"
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+def channel_post_link(message_id: Optional[int]) -> str:
+    """Ссылка на пост в канале: @username -> t.me/username/N, -100... -> t.me/c/.../N."""
+    if not message_id:
+        return ""
+    channel = str(CHANNEL_ID)
+    if channel.startswith("@"):
+        return f"https://t.me/{channel[1:]}/{message_id}"
+    if channel.startswith("-100"):
+        return f"https://t.me/c/{channel[4:]}/{message_id}"
+    return ""
+
 def html_link_title(title: str, url: str) -> str:
     safe_url = url.replace('"', "%22").replace("<", "").replace(">", "")
     safe_title = (title or url).replace("<", "").replace(">", "")
     return f'<b><a href="{safe_url}">{safe_title}</a></b>'
 
-async def fetch_title_from_url(url: str) -> str:
+# ---------- HTTP ----------
+HTTP_HEADERS = {"User-Agent": "Mozilla/5.0"}
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100"))          # соединений всего
+HTTP_PER_HOST = int(os.getenv("HTTP_PER_HOST", "4"))                # одновременных запросов на хост
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", "300"))                # сек. кэша DNS
+HTTP_REVALIDATE_SIZE = int(os.getenv("HTTP_REVALIDATE_SIZE", "2048"))  # ответов с ETag/Last-Modified
+
+class HttpClient:
+    """
+    Общий aiohttp-клиент на всё время жизни бота: keep-alive пул соединений, DNS-кэш,
+    семафор на хост и условные запросы (If-None-Match / If-Modified-Since) для повторных ссылок.
+    """
+
+    def __init__(self, per_host: int = HTTP_PER_HOST, revalidate_size: int = HTTP_REVALIDATE_SIZE):
+        self.per_host = per_host
+        self.revalidate_size = revalidate_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._host_sems: Dict[str, asyncio.Semaphore] = {}
+        # ключ запроса -> (etag, last_modified, разобранный ответ)
+        self._validators: "OrderedDict[str, Tuple[str, str, Any]]" = OrderedDict()
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=30,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, headers=HTTP_HEADERS)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _host_sem(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).hostname or ""
+        sem = self._host_sems.get(host)
+        if sem is None:
+            sem = self._host_sems[host] = asyncio.Semaphore(self.per_host)
+        return sem
+
+    @asynccontextmanager
+    async def get(self, url: str, params: Optional[Dict[str, str]] = None,
+                  headers: Optional[Dict[str, str]] = None, timeout: float = 10):
+        await self.start()  # лениво — для CLI без main()
+        async with self._host_sem(url):
+            async with self._session.get(
+                url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as resp:
+                yield resp
+
+    async def fetch(self, url: str, reader: Callable[[aiohttp.ClientResponse], Awaitable[Any]],
+                    params: Optional[Dict[str, str]] = None, timeout: float = 10) -> Optional[Any]:
+        """
+        GET с ревалидацией: reader разбирает 200-ответ, результат запоминается вместе с ETag/Last-Modified;
+        на 304 отдаём запомненное. Неуспешный ответ — None.
+        """
+        key = url + ("?" + urlencode(sorted(params.items())) if params else "")
+        cached = self._validators.get(key)
+        headers: Dict[str, str] = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        async with self.get(url, params=params, headers=headers, timeout=timeout) as resp:
+            if resp.status == 304 and cached:
+                self._validators.move_to_end(key)
+                return cached[2]
+            if resp.status != 200:
+                return None
+            value = await reader(resp)
+            etag = resp.headers.get("ETag", "")
+            last_modified = resp.headers.get("Last-Modified", "")
+        if etag or last_modified:
+            self._validators[key] = (etag, last_modified, value)
+            self._validators.move_to_end(key)
+            while len(self._validators) > self.revalidate_size:
+                self._validators.popitem(last=False)
+        return value
+
+http_client = HttpClient()
+
+async def _read_json(resp: aiohttp.ClientResponse) -> Any:
+    return await resp.json(content_type=None)
+
+def build_caption(
+    title: str, url: str, category: str, tags: List[str],
+    dir_: str = "", dop: str = "", color: str = "", prod: str = "",
+) -> str:
+    """Подпись поста: заголовок-ссылка → кредиты → хэштеги."""
+    title_line = html_link_title(title, url)
+
+    credits_lines = []
+    if dir_:  credits_lines.append(f"dir: {dir_}")
+    if dop:   credits_lines.append(f"dop: {dop}")
+    if color: credits_lines.append(f"color: {color}")
+    if prod:  credits_lines.append(f"prod: {prod}")
+
+    parts = [title_line]
+    if credits_lines:
+        parts.append("\n".join(credits_lines))
+    if category or tags:
+        parts.append(hashtags(category, tags))
+
+    return "\n\n".join(parts).strip()
+
+def caption_hash(caption: str) -> str:
+    return hashlib.sha1(caption.encode("utf-8")).hexdigest()
+
+def ref_caption(title: str, source_url: str, category: Optional[str], tags: Optional[str],
+                dir_: Optional[str], dop: Optional[str], color: Optional[str], prod: Optional[str]) -> str:
+    """Подпись по строке refs (теги — как в колонке, 'a,b')."""
+    return build_caption(title or source_url, source_url, category or "", parse_tags(tags),
+                         dir_ or "", dop or "", color or "", prod or "")
+
+def build_media_items(media: List[Dict[str, str]], cap: str) -> List:
+    """Смешанный медиа-альбом; подпись — на первом элементе."""
+    items = []
+    for idx, m in enumerate(media):
+        t, fid = m["type"], m["file_id"]
+        if idx == 0:
+            if t == "photo":
+                items.append(InputMediaPhoto(media=fid, caption=cap, parse_mode=ParseMode.HTML))
+            elif t == "video":
+                items.append(InputMediaVideo(media=fid, caption=cap, parse_mode=ParseMode.HTML))
+            else:
+                items.append(InputMediaAnimation(media=fid, caption=cap, parse_mode=ParseMode.HTML))
+        else:
+            if t == "photo":
+                items.append(InputMediaPhoto(media=fid))
+            elif t == "video":
+                items.append(InputMediaVideo(media=fid))
+            else:
+                items.append(InputMediaAnimation(media=fid))
+    return items
+
+# ---------- TITLE RESOLVER ----------
+# Все стратегии стартуют параллельно; ответ берём по приоритету (yt-dlp -> oEmbed -> Instagram -> og/<title>),
+# остальные задачи отменяем. Общий дедлайн на ссылку — чтобы медленный сайт не держал чат.
+TITLE_DEADLINE = float(os.getenv("TITLE_DEADLINE", "12"))
+
+class _QuietLogger:
+    def debug(self, msg): pass
+    def info(self, msg): pass
+    def warning(self, msg): pass
+    def error(self, msg): pass
+
+def _rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _ytdlp_worker(conn, opts: Dict, impersonate: Optional[str]) -> None:
+    """Тело процесса пула: один прогретый YoutubeDL, URL приходят по pipe, None — выход."""
+    import yt_dlp
+    opts = dict(opts, logger=_QuietLogger())
+    if impersonate:
+        from yt_dlp.networking.impersonate import ImpersonateTarget
+        opts["impersonate"] = ImpersonateTarget.from_str(impersonate)
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        while True:
+            try:
+                url = conn.recv()
+            except EOFError:
+                break
+            if url is None:
+                break
+            try:
+                info = ydl.extract_info(url, download=False) or {}
+                title = (info.get("title") or "").strip()
+            except Exception:
+                title = ""
+            conn.send((title, _rss_mb()))
+
+class _YtdlpWorker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(
+            target=_ytdlp_worker,
+            args=(child, yt_dlp_meta_opts(), YTDLP_IMPERSONATE),
+            name="yt-dlp-worker",
+            daemon=True,
+        )
+        self.proc.start()
+        child.close()
+        self.jobs = 0
+
+    def run(self, url: str, timeout: float) -> Tuple[str, float]:
+        self.conn.send(url)
+        if not self.conn.poll(timeout):
+            raise TimeoutError(url)
+        return self.conn.recv()
+
+    def stop(self, kill: bool = False) -> None:
+        if kill:
+            self.proc.kill()
+        else:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+        self.proc.join(timeout=2)
+        if self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join()
+        self.conn.close()
+
+class YtdlpPool:
+    """
+    Пул долгоживущих процессов с прогретым yt_dlp.YoutubeDL: без старта интерпретатора,
+    импорта экстракторов и настройки cookies на каждую ссылку.
+    Воркер пересоздаётся после таймаута/ошибки, YTDLP_MAX_JOBS задач или роста RSS.
+    """
+
+    def __init__(
+        self,
+        size: int = YTDLP_POOL_SIZE,
+        job_timeout: float = YTDLP_JOB_TIMEOUT,
+        max_jobs: int = YTDLP_MAX_JOBS,
+        max_rss_mb: int = YTDLP_MAX_RSS_MB,
+    ):
+        self.size = size
+        self.job_timeout = job_timeout
+        self.max_jobs = max_jobs
+        self.max_rss_mb = max_rss_mb
+        self._ctx = multiprocessing.get_context("spawn")
+        self._idle: Optional[asyncio.Queue] = None
+        self._workers: set = set()
+        self._tasks: set = set()
+        self._closing = False
+
+    @property
+    def running(self) -> bool:
+        return self._idle is not None and bool(self._workers)
+
+    async def start(self) -> None:
+        if self.size <= 0 or self._idle is not None:
+            return
+        try:
+            import yt_dlp  # noqa: F401
+        except ImportError:
+            return  # остаётся CLI
+        self._closing = False
+        self._idle = asyncio.Queue()
+        for _ in range(self.size):
+            self._idle.put_nowait(await asyncio.to_thread(self._spawn))
+
+    def _spawn(self) -> _YtdlpWorker:
+        w = _YtdlpWorker(self._ctx)
+        self._workers.add(w)
+        return w
+
+    async def extract_title(self, url: str) -> str:
+        w = await self._idle.get()
+        fut = asyncio.ensure_future(asyncio.to_thread(w.run, url, self.job_timeout))
+
+        def _done(f: asyncio.Future) -> None:
+            task = asyncio.ensure_future(self._release(w, f))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        fut.add_done_callback(_done)
+        # Отмена (дедлайн резолвера) не рвёт pipe: воркер вернётся в пул по завершении задачи
+        title, _ = await asyncio.shield(fut)
+        return title
+
+    async def _release(self, w: _YtdlpWorker, fut: asyncio.Future) -> None:
+        failed = fut.cancelled() or fut.exception() is not None
+        recycle = failed
+        if not failed:
+            w.jobs += 1
+            rss = fut.result()[1]
+            recycle = w.jobs >= self.max_jobs or (self.max_rss_mb and rss > self.max_rss_mb)
+        if recycle or self._closing:
+            self._workers.discard(w)
+            await asyncio.to_thread(w.stop, failed)
+            if self._closing:
+                return
+            try:
+                w = await asyncio.to_thread(self._spawn)
+            except Exception:
+                return
+        self._idle.put_nowait(w)
+
+    async def close(self) -> None:
+        self._closing = True
+        workers = list(self._workers)
+        self._workers.clear()
+        await asyncio.gather(*(asyncio.to_thread(w.stop) for w in workers))
+        self._idle = None
+
+ytdlp_pool = YtdlpPool()
+
+async def _title_via_ytdlp(url: str, page: "PageFetch") -> str:
+    """yt-dlp: прогретый пул процессов; без пула — CLI --skip-download, убиваем при отмене."""
+    if ytdlp_pool.running:
+        return await ytdlp_pool.extract_title(url)
+    proc = await asyncio.create_subprocess_exec(
+        "yt-dlp", "-j", "--skip-download", "--no-playlist", "--flat-playlist", "--playlist-items", "1",
+        url, *yt_dlp_meta_args(),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    try:
+        out, _ = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    if proc.returncode != 0 or not out:
+        return ""
+    data = json.loads(out.decode("utf-8", "replace").splitlines()[0])
+    return (data.get("title") or "").strip()
+
+# (подстроки URL, endpoint, доп. параметры) — первый подходящий провайдер
+OEMBED_PROVIDERS: List[Tuple[Tuple[str, ...], str, Dict[str, str]]] = [
+    (("youtube.com", "youtu.be"), "https://www.youtube.com/oembed", {"format": "json"}),
+    (("vimeo.com",), "https://vimeo.com/api/oembed.json", {}),
+]
+
+def oembed_provider(url: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    for needles, endpoint, extra in OEMBED_PROVIDERS:
+        if any(n in url for n in needles):
+            return endpoint, extra
+    return None
+
+async def _title_via_oembed(url: str, page: "PageFetch") -> str:
+    """oEmbed (YouTube/Vimeo)."""
+    provider = oembed_provider(url)
+    if provider is None:
+        return ""
+    endpoint, extra = provider
+    data = await http_client.fetch(endpoint, _read_json, params={"url": url, **extra}, timeout=8)
+    return ((data or {}).get("title") or "").strip()
+
+# ---- Страница: один потоковый проход по <head> ----
+PAGE_MAX_BYTES = int(os.getenv("PAGE_MAX_BYTES", str(512 * 1024)))  # бюджет чтения на страницу
+META_KEYS = {"og:title", "twitter:title", "og:url", "author", "twitter:creator"}
+IG_HANDLE_RE = re.compile(r"\(@([\w.]+)\)")
+
+class _MetaParser(HTMLParser):
+    """Инкрементальный парсер: og:title, twitter:title, <title>, автор — до </head>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta: Dict[str, str] = {}
+        self.done = False
+        self._title: Optional[List[str]] = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "meta":
+            a = dict(attrs)
+            key = (a.get("property") or a.get("name") or "").lower()
+            if key in META_KEYS and key not in self.meta:
+                self.meta[key] = re.sub(r"\s+", " ", a.get("content") or "").strip()
+        elif tag == "title" and "title" not in self.meta:
+            self._title = []
+        elif tag == "body":
+            self.done = True
+
+    def handle_data(self, data):
+        if self._title is not None:
+            self._title.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self._title is not None:
+            self.meta["title"] = re.sub(r"\s+", " ", "".join(self._title)).strip()
+            self._title = None
+        elif tag == "head":
+            self.done = True
+
+def _author_handle(meta: Dict[str, str]) -> str:
+    """Ник автора: '(@nick)' в заголовках, twitter:creator или первый сегмент og:url (Instagram)."""
+    for key in ("og:title", "title"):
+        m = IG_HANDLE_RE.search(meta.get(key, ""))
+        if m:
+            return m.group(1)
+    creator = meta.get("twitter:creator", "").lstrip("@")
+    if creator:
+        return creator
+    seg = urlsplit(meta.get("og:url", "")).path.strip("/").split("/")[0]
+    return seg if seg and seg not in ("p", "reel", "reels", "tv", "stories") else ""
+
+async def _read_page_meta(resp: aiohttp.ClientResponse) -> Dict[str, str]:
+    parser = _MetaParser()
+    try:
+        decoder = codecs.getincrementaldecoder(resp.charset or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    read = 0
+    async for chunk in resp.content.iter_chunked(16 * 1024):
+        read += len(chunk)
+        parser.feed(decoder.decode(chunk))
+        if parser.done or read >= PAGE_MAX_BYTES:
+            break
+    meta = parser.meta
+    meta["author_handle"] = _author_handle(meta)
+    return meta
+
+async def fetch_page_meta(url: str) -> Dict[str, str]:
+    """Потоково читает страницу до </head> (или PAGE_MAX_BYTES) и парсит мета-теги за один проход."""
+    return await http_client.fetch(url, _read_page_meta, timeout=10) or {}
+
+class PageFetch:
+    """Одна загрузка страницы на ссылку — общая для стратегий instagram и html."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self._task: Optional[asyncio.Task] = None
+
+    async def meta(self) -> Dict[str, str]:
+        if self._task is None:
+            self._task = asyncio.ensure_future(fetch_page_meta(self.url))
+        # shield: отмена одной стратегии не рвёт загрузку для другой
+        return await asyncio.shield(self._task)
+
+    def cancel(self) -> None:
+        if self._task is None:
+            return
+        if self._task.done():
+            _task_title(self._task)
+        else:
+            self._task.cancel()
+
+async def _title_via_instagram(url: str, page: PageFetch) -> str:
+    """Instagram — ник автора (из og:title, иначе @handle)."""
+    if "instagram.com" not in url:
+        return ""
+    meta = await page.meta()
+    raw = meta.get("og:title", "")
+    raw = re.sub(r"\s*•.*Instagram.*", "", raw, flags=re.I)
+    raw = re.sub(r"\s*on Instagram.*", "", raw, flags=re.I)
+    raw = raw.strip()
+    if raw:
+        return raw
+    handle = meta.get("author_handle", "")
+    return f"@{handle}" if handle else ""
+
+async def _title_via_html(url: str, page: PageFetch) -> str:
+    """og:title / twitter:title, иначе <title> + обрезка ' - YouTube' / ' on Vimeo'."""
+    meta = await page.meta()
+    t = meta.get("og:title") or meta.get("twitter:title")
+    if t:
+        return t
+    t = meta.get("title", "")
+    t = re.sub(r"\s*[-–—]\s*YouTube$", "", t, flags=re.I)
+    t = re.sub(r"\s*on\s+Vimeo$", "", t, flags=re.I)
+    t = re.sub(r"\s*-\s*Vimeo$", "", t, flags=re.I)
+    return t
+
+# Порядок = приоритет ответа
+TITLE_STRATEGIES = [
+    ("ytdlp", _title_via_ytdlp),
+    ("oembed", _title_via_oembed),
+    ("instagram", _title_via_instagram),
+    ("html", _title_via_html),
+]
+
+def strategy_applies(name: str, url: str) -> bool:
+    """oEmbed и Instagram умеют только свои сайты: на чужих их не запускаем и в статистику не пишем."""
+    if name == "oembed":
+        return oembed_provider(url) is not None
+    if name == "instagram":
+        return "instagram.com" in url
+    return True
+
+# ---- Маршрутизация стратегий по доменам ----
+ROUTE_EXPLORE = float(os.getenv("ROUTE_EXPLORE", "0.1"))        # доля запросов со всеми стратегиями в исходном порядке
+ROUTE_MIN_SAMPLES = int(os.getenv("ROUTE_MIN_SAMPLES", "5"))     # меньше — домену не доверяем, порядок исходный
+ROUTE_SKIP_RATE = float(os.getenv("ROUTE_SKIP_RATE", "0.15"))    # успешность ниже — стратегию не запускаем
+ROUTE_DECAY = float(os.getenv("ROUTE_DECAY", "0.95"))            # затухание счётчиков на каждый исход
+ROUTE_LATENCIES = 32                                             # задержек на стратегию для перцентилей
+ROUTE_FLUSH_EVERY = float(os.getenv("ROUTE_FLUSH_EVERY", "30"))  # сек. между записями в strategy_stats
+ROUTE_STATS_TTL = 30 * 24 * 3600                                 # не обновлялась месяц — забываем
+
+class StrategyRouter:
+    """
+    Для каждого домена и стратегии копим затухающие ok/fail и последние задержки (strategy_stats).
+    План резолва: стратегии с устойчиво низкой успешностью не запускаются, остальные упорядочены
+    по успешности, затем по медиане задержки — быстрый рабочий ответ больше не ждёт медленных.
+    Домен с малой историей идёт исходным порядком: общая статистика по чужим сайтам ему не указ
+    (ytdlp/html на случайных страницах падают, а на YouTube/Vimeo работают).
+    С вероятностью ROUTE_EXPLORE идём исходным TITLE_STRATEGIES, чтобы заметить, что сайт изменился.
+    """
+
+    def __init__(self, explore: float = ROUTE_EXPLORE):
+        self.explore = explore
+        self._stats: Dict[Tuple[str, str], List] = {}  # (domain, strategy) -> [ok, fail, latencies]
+        self._dirty: set = set()
+        self._flushed_at = time.monotonic()
+
+    def load(self, conn: sqlite3.Connection) -> None:
+        conn.execute("DELETE FROM strategy_stats WHERE updated_at < ?", (time.time() - ROUTE_STATS_TTL,))
+        for domain, strategy, ok, fail, latencies in conn.execute(
+            "SELECT domain, strategy, ok, fail, latencies FROM strategy_stats"
+        ):
+            self._stats[(domain, strategy)] = [ok, fail, json.loads(latencies)]
+
+    @staticmethod
+    def _rate(st: List) -> float:
+        return (st[0] + 1) / (st[0] + st[1] + 2)
+
+    @staticmethod
+    def _median(st: List) -> float:
+        lat = sorted(st[2])
+        return lat[len(lat) // 2] if lat else TITLE_DEADLINE
+
+    def _stat(self, domain: str, strategy: str) -> Optional[List]:
+        st = self._stats.get((domain, strategy))
+        return st if st is not None and st[0] + st[1] >= ROUTE_MIN_SAMPLES else None
+
+    def plan(self, domain: str, url: str) -> List[Tuple[str, Callable[[str, "PageFetch"], Awaitable[str]]]]:
+        strategies = [(name, fn) for name, fn in TITLE_STRATEGIES if strategy_applies(name, url)]
+        if random.random() < self.explore:
+            return strategies
+        ranked = []
+        for pos, (name, fn) in enumerate(strategies):
+            st = self._stat(domain, name)
+            if st is None:
+                ranked.append(((-0.5, TITLE_DEADLINE, pos), name, fn))
+            elif self._rate(st) >= ROUTE_SKIP_RATE:
+                # успешность грубо (шаг 0.2), чтобы порядок не дёргался от каждого исхода
+                ranked.append(((-round(self._rate(st) * 5) / 5, self._median(st), pos), name, fn))
+        if not ranked:
+            return strategies
+        return [(name, fn) for _, name, fn in sorted(ranked, key=lambda r: r[0])]
+
+    def record(self, domain: str, strategy: str, ok: bool, latency: float) -> None:
+        key = (domain, strategy)
+        st = self._stats.setdefault(key, [0.0, 0.0, []])
+        st[0] = st[0] * ROUTE_DECAY + ok
+        st[1] = st[1] * ROUTE_DECAY + (not ok)
+        st[2] = (st[2] + [round(latency, 3)])[-ROUTE_LATENCIES:]
+        self._dirty.add(key)
+        if time.monotonic() - self._flushed_at >= ROUTE_FLUSH_EVERY:
+            self.flush()
+
+    def flush(self) -> None:
+        self._flushed_at = time.monotonic()
+        if not self._dirty:
+            return
+        now = time.time()
+        rows = [(d, s, *self._stats[(d, s)][:2], json.dumps(self._stats[(d, s)][2]), now) for d, s in self._dirty]
+        self._dirty.clear()
+        db.submit(lambda conn: conn.executemany(
+            "INSERT OR REPLACE INTO strategy_stats(domain, strategy, ok, fail, latencies, updated_at) "
+            "VALUES (?,?,?,?,?,?)", rows,
+        ))  # коммит не ждём
+
+strategy_router = StrategyRouter()
+
+def _task_title(task: asyncio.Task) -> str:
+    if task.cancelled() or task.exception() is not None:
+        return ""
+    return task.result() or ""
+
+async def resolve_title(url: str, deadline: float = TITLE_DEADLINE) -> Tuple[str, str]:
+    """
+    Запускает стратегии из плана StrategyRouter разом и возвращает (title, strategy) первой успешной
+    по приоритету плана. По истечении дедлайна отдаём лучший из уже готовых ответов; незавершённые
+    задачи отменяются. Исход каждой завершившейся стратегии (и таймауты) идёт в статистику домена.
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    until = started + deadline
+    domain = url_host(url)
+    page = PageFetch(url)
+    tasks = [(name, asyncio.create_task(fn(url, page), name=f"title:{name}"))
+             for name, fn in strategy_router.plan(domain, url)]
+
+    def _record(name: str, t: asyncio.Task) -> None:
+        if not t.cancelled():  # отменённые после победы другой стратегии ничего не говорят
+            ok, latency = bool(_task_title(t)), loop.time() - started
+            strategy_router.record(domain, name, ok, latency)
+            metrics.observe("refbot_title_strategy_seconds", latency, strategy=name, outcome="ok" if ok else "fail")
+
+    for name, t in tasks:
+        t.add_done_callback(lambda t, name=name: _record(name, t))
+    try:
+        pending = {t for _, t in tasks}
+        while True:
+            for name, t in tasks:
+                if not t.done():
+                    break
+                title = _task_title(t)
+                if title:
+                    return title, name
+            else:
+                return "", ""
+            timeout = until - loop.time()
+            if timeout <= 0:
+                break
+            _, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        # Дедлайн: берём лучший из готовых
+        for name, t in tasks:
+            if t.done() and _task_title(t):
+                return _task_title(t), name
+        return "", ""
+    finally:
+        timed_out = loop.time() >= until
+        for name, t in tasks:
+            if t.done():
+                _task_title(t)  # помечаем исключение прочитанным
+            else:
+                if timed_out:
+                    strategy_router.record(domain, name, False, deadline)
+                    metrics.observe("refbot_title_strategy_seconds", deadline, strategy=name, outcome="timeout")
+                t.cancel()
+        page.cancel()
+
+# ---------- TITLE CACHE ----------
+TITLE_CACHE_TTL = float(os.getenv("TITLE_CACHE_TTL", str(7 * 24 * 3600)))   # удачные заголовки
+TITLE_CACHE_NEG_TTL = float(os.getenv("TITLE_CACHE_NEG_TTL", "600"))         # неудачи — коротко
+TITLE_CACHE_MEM_SIZE = int(os.getenv("TITLE_CACHE_MEM_SIZE", "2048"))        # LRU в памяти
+TITLE_CACHE_MAX_ROWS = int(os.getenv("TITLE_CACHE_MAX_ROWS", "50000"))       # потолок таблицы
+
+class TitleCache:
+    """Двухуровневый кэш заголовков: LRU в памяти + таблица title_cache в references.db."""
+
+    PRUNE_EVERY = 100  # подрезаем таблицу раз в N записей
+
+    def __init__(self, mem_size: int = TITLE_CACHE_MEM_SIZE, max_rows: int = TITLE_CACHE_MAX_ROWS):
+        self.mem_size = mem_size
+        self.max_rows = max_rows
+        self._mem: "OrderedDict[str, Tuple[str, str, float]]" = OrderedDict()
+        self._writes = 0
+
+    @staticmethod
+    def _fresh(title: str, fetched_at: float) -> bool:
+        ttl = TITLE_CACHE_TTL if title else TITLE_CACHE_NEG_TTL
+        return time.time() - fetched_at < ttl
+
+    def _remember(self, key: str, entry: Tuple[str, str, float]) -> None:
+        self._mem[key] = entry
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_size:
+            self._mem.popitem(last=False)
+
+    @staticmethod
+    def _db_get(key: str) -> Callable[[sqlite3.Connection], Optional[Tuple[str, str, float]]]:
+        def _get(conn: sqlite3.Connection):
+            row = conn.execute("SELECT title, strategy, fetched_at FROM title_cache WHERE url=?", (key,)).fetchone()
+            return (row[0], row[1] or "", row[2]) if row else None
+        return _get
+
+    def _db_put(self, key: str, entry: Tuple[str, str, float], prune: bool) -> Callable[[sqlite3.Connection], None]:
+        def _put(conn: sqlite3.Connection):
+            conn.execute(
+                "INSERT OR REPLACE INTO title_cache(url,title,strategy,fetched_at) VALUES (?,?,?,?)",
+                (key, *entry),
+            )
+            if prune:
+                conn.execute(
+                    "DELETE FROM title_cache WHERE url IN "
+                    "(SELECT url FROM title_cache ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_rows,),
+                )
+        return _put
+
+    async def get(self, url: str) -> Optional[Tuple[str, str]]:
+        """(title, strategy) или None, если записи нет/протухла. title='' — недавняя неудача."""
+        key = canonical_url(url)
+        entry = self._mem.get(key)
+        if entry is None:
+            entry = await db.read(self._db_get(key))
+            if entry is None:
+                return None
+        if not self._fresh(entry[0], entry[2]):
+            self._mem.pop(key, None)
+            return None
+        self._remember(key, entry)
+        return entry[0], entry[1]
+
+    def put(self, url: str, title: str, strategy: str) -> None:
+        key = canonical_url(url)
+        entry = (title, strategy, time.time())
+        self._remember(key, entry)
+        self._writes += 1
+        db.submit(self._db_put(key, entry, self._writes % self.PRUNE_EVERY == 0))  # коммит не ждём
+
+title_cache = TitleCache()
+
+async def fetch_title_from_url(url: str) -> str:
+    """
+    1) yt-dlp --skip-download (+ cookies/impersonate из ENV)
+    2) oEmbed (YouTube/Vimeo)
+    2.5) Instagram — ник автора
+    3) og:title / twitter:title
+    4) <title>  + обрезка ' - YouTube' / ' on Vimeo'
+    Всё — параллельно и не блокируя event loop, с общим дедлайном TITLE_DEADLINE.
+    Набор и приоритет стратегий для домена выбирает StrategyRouter по накопленной статистике.
+    Повторные ссылки отдаются из title_cache (включая недавние неудачи).
+    """
+    cached = await title_cache.get(url)
+    metrics.inc("refbot_title_cache_total", result="miss" if cached is None else "hit")
+    if cached is not None:
+        return cached[0]
+    started = time.perf_counter()
+    title, strategy = await resolve_title(url)
+    metrics.observe("refbot_title_resolve_seconds", time.perf_counter() - started, strategy=strategy or "none")
+    title_cache.put(url, title, strategy)
+    return title
+
+# ---------- PUBLISHING ----------
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 сообщений/мин в группу/канал (альбом = N сообщений)
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", "2"))
+PUBLISH_GLOBAL_RATE = float(os.getenv("PUBLISH_GLOBAL_RATE", "25"))        # сообщений/с
+PUBLISH_CHAT_RATE = float(os.getenv("PUBLISH_CHAT_RATE", "20")) / 60      # сообщений/с в один чат
+PUBLISH_CHAT_BURST = float(os.getenv("PUBLISH_CHAT_BURST", "20"))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv("PUBLISH_MAX_ATTEMPTS", "8"))
+PUBLISH_BACKOFF_MAX = float(os.getenv("PUBLISH_BACKOFF_MAX", "300"))
+
+class TokenBucket:
+    """Токен-бакет: rate токенов/с, не больше capacity; block() — пауза по RetryAfter."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def block(self, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, cost: float = 1.0) -> None:
+        cost = min(cost, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = self.blocked_until - now
+            if wait <= 0 and self.tokens >= cost:
+                self.tokens -= cost
+                return
+            await asyncio.sleep(max(wait, (cost - self.tokens) / self.rate))
+
+class JobQueue:
+    """
+    Очередь заданий в таблице SQLite (status pending → <busy> → done/failed, next_at, attempts):
+    бэклог и рестарты переживает сама таблица. Воркеры забирают ближайшее готовое задание, без работы
+    спят до MIN(next_at) или wake(). Ошибки _process: RetryAfter — повтор ровно через retry_after без
+    траты попытки, transient — экспоненциальная пауза до max_attempts, остальные — сразу failed.
+    Подкласс задаёт таблицу и _process(*job); job — строка columns: первым ключ, последним attempts.
+    """
+
+    table = ""
+    key = "id"
+    columns = "id, attempts"
+    busy = "sending"
+    stamped = False            # есть колонка updated_at
+    metric = ""                # счётчик исходов с меткой result
+    idle_timeout = 30.0
+    max_attempts = 8
+    transient: Tuple[type, ...] = (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError)
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.bot: Optional[Bot] = None
+        self._wake = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    async def start(self, bot: Bot) -> None:
+        self.bot = bot
+        # задание, прерванное падением, — снова в очередь: неизвестно, успело ли оно
+        await db.write(lambda conn: conn.execute(
+            f"UPDATE {self.table} SET status='pending' WHERE status='{self.busy}'",
+        ))
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def close(self) -> None:
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _set(self, conn: sqlite3.Connection, key: Any, assignments: str, params: Tuple = ()) -> None:
+        if self.stamped:
+            assignments += ", updated_at=?"
+            params += (time.time(),)
+        conn.execute(f"UPDATE {self.table} SET {assignments} WHERE {self.key}=?", params + (key,))
+
+    def _claim(self, conn: sqlite3.Connection) -> Optional[Tuple]:
+        row = conn.execute(
+            f"SELECT {self.columns} FROM {self.table} "
+            f"WHERE status='pending' AND next_at <= ? ORDER BY next_at, {self.key} LIMIT 1",
+            (time.time(),),
+        ).fetchone()
+        if row is not None:
+            self._set(conn, row[0], f"status='{self.busy}', attempts=attempts+1")
+        return row
+
+    async def _worker(self) -> None:
+        while True:
+            self._wake.clear()
+            job = await db.write(self._claim)
+            if job is None:
+                next_at = await db.read(lambda conn: conn.execute(
+                    f"SELECT MIN(next_at) FROM {self.table} WHERE status='pending'",
+                ).fetchone()[0])
+                timeout = self.idle_timeout if next_at is None else min(max(next_at - time.time(), 0.05),
+                                                                        self.idle_timeout)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._process(*job)
+            except asyncio.CancelledError:
+                raise
+            except TelegramRetryAfter as e:
+                await self._retry(job, e.retry_after, self._error_text(e), refund=True)
+            except self.transient as e:
+                if job[-1] + 1 >= self.max_attempts:
+                    await self._fail(job, self._error_text(e))
+                else:
+                    delay = min(2 ** job[-1], PUBLISH_BACKOFF_MAX) * (1 + random.random() / 2)
+                    await self._retry(job, delay, self._error_text(e))
+            except Exception as e:  # повторять бессмысленно
+                error = self._error_text(e)
+                log.warning("%s %s failed: %s", self.table, job[0], error)
+                await self._fail(job, error)
+
+    async def _process(self, *job: Any) -> None:
+        raise NotImplementedError
+
+    def _error_text(self, e: BaseException) -> str:
+        return str(e)
+
+    async def _retry(self, job: Tuple, delay: float, error: str, refund: bool = False) -> None:
+        metrics.inc(self.metric, result="retry_after" if refund else "retry")
+        # RetryAfter — не неудача, попытку не засчитываем
+        await db.write(lambda conn: self._set(
+            conn, job[0], "status='pending', next_at=?, error=?, attempts=attempts-?",
+            (time.time() + delay, error, int(refund)),
+        ))
+        self._wake.set()
+
+    async def _fail(self, job: Tuple, error: str) -> None:
+        metrics.inc(self.metric, result="failed")
+        await db.write(lambda conn: self._set(conn, job[0], "status='failed', error=?", (error,)))
+
+class Publisher(JobQueue):
+    """
+    Исходящая очередь публикаций (JobQueue над publish_jobs): задания переживают рестарт.
+    Воркеры отправляют их через токен-бакеты (общий и на чат), RetryAfter выдерживают ровно,
+    сетевые/5xx ошибки повторяют с экспоненциальной паузой. Запись в refs — только после
+    подтверждённой отправки, в одной транзакции с закрытием задания.
+    """
+
+    table = "publish_jobs"
+    columns = "id, chat_id, reply_chat_id, payload, attempts"
+    metric = "refbot_publish_total"
+    max_attempts = PUBLISH_MAX_ATTEMPTS
+
+    def __init__(self, workers: int = PUBLISH_WORKERS):
+        super().__init__(workers)
+        self._global = TokenBucket(PUBLISH_GLOBAL_RATE, PUBLISH_GLOBAL_RATE)
+        self._chats: Dict[str, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(PUBLISH_CHAT_RATE, PUBLISH_CHAT_BURST)
+        return bucket
+
+    @staticmethod
+    def insert_job(conn: sqlite3.Connection, chat_id: str, reply_chat_id: Optional[int], caption: str,
+                   media: List[Dict[str, str]], ref: Dict[str, Any]) -> int:
+        """Задание в очередь внутри транзакции писателя (вместе с другой работой)."""
+        payload = json.dumps({"caption": caption, "media": media, "ref": ref}, ensure_ascii=False)
+        return conn.execute(
+            "INSERT INTO publish_jobs(chat_id, reply_chat_id, payload, next_at, created_at) VALUES (?,?,?,?,?)",
+            (str(chat_id), reply_chat_id, payload, time.time(), datetime.utcnow().isoformat()),
+        ).lastrowid
+
+    async def enqueue(self, chat_id: str, reply_chat_id: Optional[int], caption: str,
+                      media: List[Dict[str, str]], ref: Dict[str, Any]) -> int:
+        job_id = await db.write(lambda conn: self.insert_job(conn, chat_id, reply_chat_id, caption, media, ref))
+        self._wake.set()
+        return job_id
+
+    async def _process(self, job_id: int, chat_id: str, reply_chat_id: Optional[int],
+                       payload: str, attempts: int) -> None:
+        p = json.loads(payload)
+        media, caption = p["media"], p["caption"]
+        dup = await find_ref_by_url(p["ref"].get("source_url", ""))
+        if dup is not None:
+            # та же ссылка вышла, пока задание стояло в очереди
+            await db.write(lambda conn: conn.execute(
+                "UPDATE publish_jobs SET status='done', ref_id=?, error='duplicate' WHERE id=?", (dup[0], job_id),
+            ))
+            metrics.inc("refbot_publish_total", result="duplicate")
+            await self._notify(reply_chat_id, duplicate_note(dup))
+            return
+        cost = max(len(media), 1)
+        bucket = self._chat_bucket(chat_id)
+        await bucket.acquire(cost)
+        await self._global.acquire(cost)
+        try:
+            if media:
+                msgs = await self.bot.send_media_group(chat_id=chat_id, media=build_media_items(media, caption))
+                first_id = msgs[0].message_id if msgs else None
+            else:
+                sent = await self.bot.send_message(chat_id=chat_id, text=caption, parse_mode=ParseMode.HTML)
+                first_id = sent.message_id
+        except TelegramRetryAfter as e:
+            bucket.block(e.retry_after)  # повтор задания — в JobQueue._worker
+            raise
+
+        def _complete(conn: sqlite3.Connection) -> int:
+            ref_id = _insert_reference(conn, channel_message_id=first_id, media=media, **p["ref"])
+            conn.execute("UPDATE refs SET caption_hash=? WHERE id=?", (caption_hash(caption), ref_id))
+            conn.execute("UPDATE publish_jobs SET status='done', ref_id=?, error=NULL WHERE id=?", (ref_id, job_id))
+            return ref_id
+
+        await db.write(_complete)
+        media_archive.wake()
+        metrics.inc("refbot_publish_total", result="done")
+        await self._notify(reply_chat_id, "Готово! Пост опубликован в канале ✅")
+
+    async def _fail(self, job: Tuple, error: str) -> None:
+        await super()._fail(job, error)
+        await self._notify(job[2], "Не удалось опубликовать в канал. Проверь права бота и CHANNEL_ID.")
+
+    async def _notify(self, chat_id: Optional[int], text: str) -> None:
+        if chat_id is None:
+            return
+        try:
+            await self.bot.send_message(chat_id, text, reply_markup=reply_menu())
+        except Exception:
+            pass
+
+publisher = Publisher()
+
+# ---------- IMAGE HASHES ----------
+# dHash (64 бита) по фото и превью видео/GIF: та же картинка под другой ссылкой находится
+# и после пересжатия/ресайза. Поиск — multi-index hashing: хэш режется на 4 куска по 16 бит,
+# при расстоянии <= r хотя бы один кусок отличается не больше чем на r // 4 бит (принцип Дирихле).
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "1") == "1"          # нужен Pillow; без него — выключено
+PHASH_WORKERS = int(os.getenv("PHASH_WORKERS", "1"))            # процессов для хэширования
+PHASH_CONCURRENCY = int(os.getenv("PHASH_CONCURRENCY", "4"))    # одновременных загрузок из Telegram
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))  # бит различия, до которых «похоже»
+PHASH_PHOTO_SIDE = 640                                          # размер фото для хэша (9x8 хватает с запасом)
+PHASH_UNLINKED_TTL = 7 * 24 * 3600                              # хэши неопубликованных картинок
+PHASH_BACKLOG_BATCH = 100
+
+def _dhash(data: bytes) -> int:
+    """Тело процесса пула: картинка -> 64-битный difference hash."""
+    from PIL import Image
+    with Image.open(io.BytesIO(data)) as im:
+        px = list(im.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (px[row * 9 + col] > px[row * 9 + col + 1])
+    return h
+
+def _hash_chunks(h: int) -> Tuple[int, int, int, int]:
+    return tuple((h >> shift) & 0xFFFF for shift in (48, 32, 16, 0))
+
+def _chunk_neighbors(chunk: int, radius: int) -> List[int]:
+    """Все 16-битные значения на расстоянии Хэмминга <= radius от chunk."""
+    found = {chunk}
+    for _ in range(radius):
+        found |= {v ^ (1 << bit) for v in found for bit in range(16)}
+    return sorted(found)
+
+def _signed64(h: int) -> int:
+    return h - (1 << 64) if h >= 1 << 63 else h
+
+def image_ref(msg: Message) -> Optional[Tuple[str, str]]:
+    """(file_unique_id, file_id) картинки для хэша: фото подходящего размера или превью видео/GIF."""
+    if msg.photo:
+        sizes = [p for p in msg.photo if max(p.width, p.height) <= PHASH_PHOTO_SIDE] or msg.photo[:1]
+        pic = sizes[-1]
+    else:
+        media = msg.video or msg.animation
+        pic = media.thumbnail if media else None
+    return (pic.file_unique_id, pic.file_id) if pic else None
+
+def _link_image_hashes(conn: sqlite3.Connection, ref_id: int, media: List[Dict[str, str]]) -> None:
+    """Хэши вложений, посчитанные при сборе медиа, привязываются к опубликованному посту."""
+    conn.executemany(
+        "UPDATE image_hashes SET ref_id=? WHERE media_file_id=? AND ref_id IS NULL",
+        [(ref_id, m["file_id"]) for m in media],
+    )
+
+class ImageIndex:
     """
-    1) yt-dlp --skip-download (+ cookies/impersonate из ENV)
-    2) oEmbed (YouTube/Vimeo)
-    2.5) Instagram — ник автора
-    3) og:title / twitter:title
-    4) <title>  + обрезка ' - YouTube' / ' on Vimeo'
+    Фоновый конвейер: загрузка картинки из Telegram -> dHash в пуле процессов -> image_hashes.
+    Во время сбора медиа предупреждает, если картинка уже есть в архиве; то же — /similar.
+    При старте дохэширует фото постов, опубликованных до индекса (checkpoint в job_state).
     """
-    import subprocess, html as htmlmod
-    # 1) yt-dlp
-    try:
-        cmd = ["yt-dlp", "-j", "--skip-download", url] + yt_dlp_meta_args()
-        out = subprocess.check_output(cmd, text=True, stderr=subprocess.STDOUT)
-        data = json.loads(out.splitlines()[0])
-        t = (data.get("title") or "").strip()
-        if t:
-            return t
-    except Exception:
-        pass
-    # 2) oEmbed
-    try:
-        if "youtube.com" in url or "youtu.be" in url:
-            r = requests.get("https://www.youtube.com/oembed",
-                             params={"url": url, "format": "json"},
-                             timeout=8, headers={"User-Agent": "Mozilla/5.0"})
-            if r.ok:
-                t = (r.json().get("title") or "").strip()
-                if t: return t
-        if "vimeo.com" in url:
-            r = requests.get("https://vimeo.com/api/oembed.json",
-                             params={"url": url},
-                             timeout=8, headers={"User-Agent": "Mozilla/5.0"})
-            if r.ok:
-                t = (r.json().get("title") or "").strip()
-                if t: return t
-    except Exception:
-        pass
-    # 2.5) Instagram — ник автора (из og:title)
-    if "instagram.com" in url:
+
+    BACKLOG_JOB = "phash:backlog"
+
+    def __init__(self, workers: int = PHASH_WORKERS, concurrency: int = PHASH_CONCURRENCY,
+                 max_distance: int = PHASH_MAX_DISTANCE):
+        self.workers = workers
+        self.max_distance = max_distance
+        self.bot: Optional[Bot] = None
+        self._sem = asyncio.Semaphore(concurrency)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._tasks: set = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self._pool is not None
+
+    def start(self, bot: Bot) -> None:
+        if not PHASH_ENABLED or self._pool is not None:
+            return
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            return
+        self.bot = bot
+        self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self._spawn(self._backlog())
+
+    async def close(self) -> None:
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _spawn(self, coro: Awaitable) -> None:
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def hash_image(self, file_id: str, media_file_id: Optional[str], unique_id: Optional[str] = None,
+                         ref_id: Optional[int] = None) -> int:
+        """dHash картинки; считается один раз на file_unique_id (без unique_id — узнаём через getFile)."""
+        async with self._sem:
+            file = None
+            if unique_id is None:
+                file = await self.bot.get_file(file_id)
+                unique_id = file.file_unique_id
+            row = await db.read(lambda conn: conn.execute(
+                "SELECT hash FROM image_hashes WHERE file_unique_id=?", (unique_id,),
+            ).fetchone())
+            if row is not None:
+                return row[0] & (2 ** 64 - 1)
+            buf = await (self.bot.download_file(file.file_path) if file else self.bot.download(file_id))
+            h = await asyncio.get_running_loop().run_in_executor(self._pool, _dhash, buf.getvalue())
+        await db.write(lambda conn: conn.execute(
+            "INSERT OR IGNORE INTO image_hashes(file_unique_id, media_file_id, hash, h0, h1, h2, h3, ref_id, created_at) "
+            "VALUES (?,?,?,?,?,?,?,?,?)",
+            (unique_id, media_file_id, _signed64(h), *_hash_chunks(h), ref_id, time.time()),
+        ))
+        return h
+
+    async def similar(self, h: int, limit: int = 10) -> List[Tuple[int, int, str, str, Optional[int]]]:
+        """Посты архива с картинкой в пределах max_distance: (distance, ref_id, title, url, channel_message_id)."""
+        radius = self.max_distance // 4
+        chunks = [_chunk_neighbors(c, radius) for c in _hash_chunks(h)]
+        where = " OR ".join(f"i.h{n} IN ({','.join(map(str, vals))})" for n, vals in enumerate(chunks))
+        rows = await db.read(lambda conn: conn.execute(
+            "SELECT i.hash, r.id, r.title, r.source_url, r.channel_message_id "
+            f"FROM image_hashes i JOIN refs r ON r.id = i.ref_id WHERE ({where})"
+        ).fetchall())
+        best: Dict[int, Tuple] = {}
+        for other, ref_id, title, url, msg_id in rows:
+            dist = bin((other & (2 ** 64 - 1)) ^ h).count("1")
+            if dist <= self.max_distance and (ref_id not in best or dist < best[ref_id][0]):
+                best[ref_id] = (dist, ref_id, title, url, msg_id)
+        return sorted(best.values())[:limit]
+
+    def watch(self, chat_id: int, items: List[Tuple[str, Tuple[str, str]]]) -> None:
+        """Хэширует только что добавленные вложения [(media_file_id, (unique_id, file_id))] и предупреждает о повторах."""
+        if self.enabled and items:
+            self._spawn(self._check(chat_id, items))
+
+    async def _check(self, chat_id: int, items: List[Tuple[str, Tuple[str, str]]]) -> None:
+        found: Dict[int, Tuple] = {}
+        for media_file_id, (unique_id, file_id) in items:
+            try:
+                h = await self.hash_image(file_id, media_file_id, unique_id)
+            except Exception:
+                continue  # не скачалось/не картинка — сбору медиа это не мешает
+            for match in await self.similar(h, limit=3):
+                if match[1] not in found or match[0] < found[match[1]][0]:
+                    found[match[1]] = match
+        if not found:
+            return
+        lines = ["⚠️ Похоже, эта картинка уже есть в архиве:"]
+        for dist, ref_id, title, url, msg_id in sorted(found.values())[:3]:
+            post = channel_post_link(msg_id)
+            name = html_escape(title or url)
+            lines.append(f'• <a href="{post}">{name}</a>' if post else f"• {name} (#{ref_id})")
         try:
-            r = requests.get(url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
-            if r.ok:
-                m = re.search(r'<meta[^>]+property=["\']og:title["\'][^>]*content=["\'](.*?)["\']', r.text, re.I)
-                if m:
-                    raw = m.group(1)
-                    raw = re.sub(r"\s*•.*Instagram.*", "", raw, flags=re.I)
-                    raw = re.sub(r"\s*on Instagram.*", "", raw, flags=re.I)
-                    return raw.strip()
+            await self.bot.send_message(chat_id, "\n".join(lines), parse_mode=ParseMode.HTML,
+                                        disable_web_page_preview=True)
         except Exception:
             pass
-    # 3) og:title / twitter:title
-    try:
-        r = requests.get(url, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
-        html_text = r.text
-        m = re.search(r'<meta[^>]+property=["\']og:title["\'][^>]*content=["\'](.*?)["\']', html_text, re.I)
-        if not m:
-            m = re.search(r'<meta[^>]+name=["\']twitter:title["\'][^>]*content=["\'](.*?)["\']', html_text, re.I)
-        if m:
-            t = re.sub(r"\s+", " ", m.group(1)).strip()
-            return htmlmod.unescape(t)
-        # 4) <title>
-        m = re.search(r"<title>(.*?)</title>", html_text, re.I | re.S)
-        if m:
-            t = htmlmod.unescape(re.sub(r"\s+", " ", m.group(1)).strip())
-            t = re.sub(r"\s*[-–—]\s*YouTube$", "", t, flags=re.I)
-            t = re.sub(r"\s*on\s+Vimeo$", "", t, flags=re.I)
-            t = re.sub(r"\s*-\s*Vimeo$", "", t, flags=re.I)
-            return t
-    except Exception:
-        pass
-    return ""
+
+    async def _backlog(self) -> None:
+        await db.write(lambda conn: conn.execute(
+            "DELETE FROM image_hashes WHERE ref_id IS NULL AND created_at < ?", (time.time() - PHASH_UNLINKED_TTL,),
+        ))
+        after = ((await db.read(lambda conn: load_checkpoint(conn, self.BACKLOG_JOB))) or {}).get("ref_id", 0)
+        while True:
+            rows = await db.read(lambda conn: conn.execute(
+                "SELECT id, media_json FROM refs WHERE id > ? ORDER BY id LIMIT ?", (after, PHASH_BACKLOG_BATCH),
+            ).fetchall())
+            if not rows:
+                return
+            for ref_id, media_json in rows:
+                for m in json.loads(media_json or "[]"):
+                    if m.get("type") != "photo":
+                        continue  # превью видео по file_id не достать
+                    known = await db.read(lambda conn: conn.execute(
+                        "SELECT 1 FROM image_hashes WHERE media_file_id=?", (m["file_id"],),
+                    ).fetchone())
+                    if known:
+                        continue
+                    try:
+                        await self.hash_image(m["file_id"], m["file_id"], ref_id=ref_id)
+                    except TelegramRetryAfter as e:
+                        await asyncio.sleep(e.retry_after)
+                    except Exception:
+                        pass  # файл недоступен — пропускаем
+            after = rows[-1][0]
+            await db.write(lambda conn: save_checkpoint(conn, self.BACKLOG_JOB, {"ref_id": after}))
+
+image_index = ImageIndex()
+
+# ---------- MEDIA ARCHIVE ----------
+# Единственная копия вложений — в Telegram (file_id в refs.media_json). Воркеры скачивают их
+# потоково (getFile + HTTP с Range-докачкой) и кладут по SHA-256: одинаковый файл из разных постов
+# хранится один раз. Очередь — сама таблица media_archive, поэтому бэклог и рестарты — бесплатно.
+# Облачный Bot API отдаёт файлы до 20 МБ; больше — статус failed с ошибкой от Telegram.
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "1") == "1"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "work/media")
+ARCHIVE_WORKERS = int(os.getenv("ARCHIVE_WORKERS", "2"))          # одновременных загрузок
+ARCHIVE_CHUNK = 256 * 1024                                         # байт на чтение из сокета
+ARCHIVE_TIMEOUT = float(os.getenv("ARCHIVE_TIMEOUT", "600"))       # сек. на один файл
+ARCHIVE_MAX_ATTEMPTS = int(os.getenv("ARCHIVE_MAX_ATTEMPTS", "8"))
+
+def _queue_media_archive(conn: sqlite3.Connection, ref_id: int, media: List[Dict[str, str]]) -> None:
+    now = time.time()
+    conn.executemany(
+        "INSERT OR IGNORE INTO media_archive(file_id, ref_id, kind, next_at, updated_at) VALUES (?,?,?,?,?)",
+        [(m["file_id"], ref_id, m.get("type"), now, now) for m in media],
+    )
+
+def archive_path(sha256: str) -> str:
+    return os.path.join(ARCHIVE_DIR, sha256[:2], sha256[2:4], sha256)
+
+def _hash_partial(path: str) -> Tuple[Any, int]:
+    """SHA-256 уже скачанной части (для докачки)."""
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+            size += len(chunk)
+    return h, size
+
+_BOT_URL_RE = re.compile(r"https?://\S*/bot[^/\s]*\S*")
+
+def archive_error(e: BaseException, token: str = "") -> str:
+    """Текст ошибки для media_archive.error: URL файла содержит токен бота — в базу его не пишем."""
+    if isinstance(e, aiohttp.ClientResponseError):
+        return f"{type(e).__name__}: HTTP {e.status}"
+    text = f"{type(e).__name__}: {e}"
+    if token:
+        text = text.replace(token, "<token>")
+    return _BOT_URL_RE.sub("<url>", text)[:500]
+
+def _store_partial(part: str, sha256: str) -> None:
+    """Готовый .part -> ARCHIVE_DIR/ab/cd/<sha256>; если такой файл уже есть — дубль просто удаляется."""
+    dest = archive_path(sha256)
+    if os.path.exists(dest):
+        os.remove(part)
+        return
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    os.replace(part, dest)
+
+class MediaArchive(JobQueue):
+    """
+    Фоновая выгрузка вложений опубликованных постов на диск. Воркеры берут задания из
+    media_archive (JobQueue, как Publisher — из publish_jobs), качают кусками по ARCHIVE_CHUNK в .part
+    с потоковым SHA-256; прерванная загрузка продолжается Range-запросом. RetryAfter не считается
+    попыткой, сетевые/5xx ошибки повторяются с экспоненциальной паузой.
+    """
+
+    table = "media_archive"
+    key = "file_id"
+    columns = "file_id, attempts"
+    busy = "downloading"
+    stamped = True
+    metric = "refbot_archive_total"
+    idle_timeout = 60.0
+    max_attempts = ARCHIVE_MAX_ATTEMPTS
+    transient = JobQueue.transient + (aiohttp.ClientError,)
+
+    def __init__(self, workers: int = ARCHIVE_WORKERS):
+        super().__init__(workers)
+
+    async def start(self, bot: Bot) -> None:
+        if not ARCHIVE_ENABLED or self._tasks:
+            return
+        # 'downloading' после рестарта: .part остался на диске — докачаем
+        os.makedirs(os.path.join(ARCHIVE_DIR, ".partial"), exist_ok=True)
+        await super().start(bot)
+
+    def _error_text(self, e: BaseException) -> str:
+        return archive_error(e, self.bot.token)
+
+    async def _process(self, file_id: str, attempts: int) -> None:
+        file = await self.bot.get_file(file_id)
+        unique_id = file.file_unique_id
+        known = await db.read(lambda conn: conn.execute(
+            "SELECT sha256 FROM media_archive WHERE file_unique_id=? AND status='done' LIMIT 1", (unique_id,),
+        ).fetchone())
+        if known is not None:  # тот же файл под другим file_id — уже в архиве
+            await self._done(file_id, unique_id, known[0], None)
+            metrics.inc("refbot_archive_total", result="duplicate")
+            return
+        # по file_id: одинаковые файлы под разными file_id могут качаться одновременно
+        part = os.path.join(ARCHIVE_DIR, ".partial", hashlib.sha1(file_id.encode()).hexdigest())
+        h, size = await asyncio.to_thread(_hash_partial, part) if os.path.exists(part) else (hashlib.sha256(), 0)
+        headers = {"Range": f"bytes={size}-"} if size else None
+        url = self.bot.session.api.file_url(self.bot.token, file.file_path)
+        async with http_client.get(url, headers=headers, timeout=ARCHIVE_TIMEOUT) as resp:
+            if resp.status == 416:
+                if file.file_size != size:  # .part не сходится с файлом — при повторе качаем с нуля
+                    os.remove(part)
+                    raise aiohttp.ClientPayloadError(f"range not satisfiable at {size} of {file.file_size} bytes")
+                # иначе скачано целиком, упали до переименования
+            elif resp.status not in (200, 206):
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status)
+            else:
+                if resp.status == 200 and size:  # Range не поддержан — заново
+                    h, size = hashlib.sha256(), 0
+                with open(part, "ab" if size else "wb") as f:
+                    async for chunk in resp.content.iter_chunked(ARCHIVE_CHUNK):
+                        await asyncio.to_thread(f.write, chunk)
+                        h.update(chunk)
+                        size += len(chunk)
+                        metrics.inc("refbot_archive_bytes_total", len(chunk))
+        if file.file_size and size != file.file_size:
+            os.remove(part)  # битая часть — при повторе качаем с нуля
+            raise aiohttp.ClientPayloadError(f"got {size} of {file.file_size} bytes")
+        sha256 = h.hexdigest()
+        await asyncio.to_thread(_store_partial, part, sha256)
+        await self._done(file_id, unique_id, sha256, size)
+        metrics.inc("refbot_archive_total", result="done")
+
+    async def _done(self, file_id: str, unique_id: str, sha256: str, size: Optional[int]) -> None:
+        def _commit(conn: sqlite3.Connection) -> None:
+            if size is not None:
+                conn.execute(
+                    "INSERT OR IGNORE INTO media_files(sha256, size, created_at) VALUES (?,?,?)",
+                    (sha256, size, time.time()),
+                )
+            conn.execute(
+                "UPDATE media_archive SET status='done', file_unique_id=?, sha256=?, error=NULL, updated_at=? "
+                "WHERE file_id=?",
+                (unique_id, sha256, time.time(), file_id),
+            )
+
+        await db.write(_commit)
+
+media_archive = MediaArchive()
 
 # ---------- ROUTER ----------
 router = Router()
@@ -314,7 +2738,196 @@ async def on_btn_stop(msg: Message, state: FSMContext):
     await state.update_data(enabled=False)
     await msg.answer("Остановился. Нажми ▶️ Старт, когда нужно продолжить.", reply_markup=reply_menu())
 
+# --- Поиск по архиву ---
+def render_search_page(query: str, rows: List[Tuple], has_more: bool) -> Tuple[str, InlineKeyboardMarkup]:
+    lines = [f"Поиск: <b>{html_escape(query)}</b>\n"]
+    for r in rows:
+        ref_id, title, url, category, msg_id, _ = r
+        post = channel_post_link(msg_id)
+        name = html_escape(title or url)
+        line = f'• <a href="{post}">{name}</a>' if post else f"• {name}"
+        if category:
+            line += f" #{category}"
+        lines.append(line)
+    buttons = [InlineKeyboardButton(text="⏮ В начало", callback_data="sr:first")]
+    if has_more:
+        last = rows[-1]
+        buttons.append(InlineKeyboardButton(text="Ещё ▶", callback_data=f"sr:{last[5]!r}:{last[0]}"))
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+@router.message(Command("search"))
+async def on_search(msg: Message, state: FSMContext, command: CommandObject):
+    query = (command.args or "").strip()
+    if not query:
+        await msg.answer("Что ищем? Например: <code>/search neon drone</code>", parse_mode=ParseMode.HTML)
+        return
+    rows = await search_refs(query, limit=SEARCH_PAGE + 1)
+    if not rows:
+        await msg.answer("Ничего не нашёл.")
+        return
+    await state.update_data(search_q=query)
+    text, kb = render_search_page(query, rows[:SEARCH_PAGE], len(rows) > SEARCH_PAGE)
+    await msg.answer(text, parse_mode=ParseMode.HTML, reply_markup=kb, disable_web_page_preview=True)
+
+@router.callback_query(F.data.startswith("sr:"))
+async def on_search_page(cb: CallbackQuery, state: FSMContext):
+    query = (await state.get_data()).get("search_q")
+    if not query:
+        await cb.answer("Поиск устарел — повтори /search", show_alert=True)
+        return
+    after = None
+    if cb.data != "sr:first":
+        _, rank, ref_id = cb.data.split(":")
+        after = (float(rank), int(ref_id))
+    rows = await search_refs(query, after=after, limit=SEARCH_PAGE + 1)
+    if not rows:
+        await cb.answer("Больше ничего")
+        return
+    text, kb = render_search_page(query, rows[:SEARCH_PAGE], len(rows) > SEARCH_PAGE)
+    await cb.message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=kb, disable_web_page_preview=True)
+    await cb.answer()
+
+# --- Похожие картинки: /similar подписью к фото или ответом на фото/видео ---
+@router.message(Command("similar"))
+async def on_similar(msg: Message):
+    if not image_index.enabled:
+        await msg.answer("Поиск похожих выключен (нужен Pillow и PHASH_ENABLED=1).")
+        return
+    pic = image_ref(msg.reply_to_message or msg)
+    if pic is None:
+        await msg.answer("Пришли /similar подписью к фото или ответом на фото/видео.")
+        return
+    try:
+        h = await image_index.hash_image(pic[1], None, pic[0])
+    except (TelegramBadRequest, TelegramNetworkError, OSError):
+        await msg.answer("Не удалось скачать картинку, попробуй ещё раз.")
+        return
+    rows = await image_index.similar(h)
+    if not rows:
+        await msg.answer("Похожих картинок в архиве нет.")
+        return
+    lines = ["Похожие посты:\n"]
+    for dist, ref_id, title, url, msg_id in rows:
+        post = channel_post_link(msg_id)
+        name = html_escape(title or url)
+        line = f'• <a href="{post}">{name}</a>' if post else f"• {name}"
+        lines.append(f"{line} — {'та же' if dist == 0 else f'отличие {dist} бит'}")
+    await msg.answer("\n".join(lines), parse_mode=ParseMode.HTML, disable_web_page_preview=True)
+
+# --- Inline-режим: @bot запрос -> готовые посты из архива (включить /setinline у BotFather) ---
+INLINE_PAGE = int(os.getenv("INLINE_PAGE", "20"))             # результатов на страницу (макс. 50)
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "60"))  # cache_time для Telegram, сек.
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "512"))
+_inline_cache: "OrderedDict[Tuple[str, str], Tuple[float, List, str]]" = OrderedDict()
+
+def inline_result(row: Tuple):
+    """Пост из архива -> InlineQueryResultCached* по file_id первого вложения (без повторной загрузки)."""
+    ref_id, title, url, category, tags, dir_, dop, color, prod, media_json = row[:10]
+    media = json.loads(media_json or "[]")
+    if not media:
+        return None
+    cap = ref_caption(title, url, category, tags, dir_, dop, color, prod)
+    kind, fid = media[0]["type"], media[0]["file_id"]
+    name = (title or url)[:64]
+    if kind == "photo":
+        return InlineQueryResultCachedPhoto(
+            id=f"r{ref_id}", photo_file_id=fid, title=name, caption=cap, parse_mode=ParseMode.HTML,
+        )
+    if kind == "video":
+        return InlineQueryResultCachedVideo(
+            id=f"r{ref_id}", video_file_id=fid, title=name, caption=cap, parse_mode=ParseMode.HTML,
+        )
+    return InlineQueryResultCachedMpeg4Gif(
+        id=f"r{ref_id}", mpeg4_file_id=fid, title=name, caption=cap, parse_mode=ParseMode.HTML,
+    )
+
+@router.inline_query()
+async def on_inline_query(iq: InlineQuery):
+    key = (iq.query.strip().lower(), iq.offset or "")
+    hit = _inline_cache.get(key)
+    if hit is not None and time.monotonic() - hit[0] < INLINE_CACHE_TIME:
+        _inline_cache.move_to_end(key)
+        results, next_offset = hit[1], hit[2]
+    else:
+        try:
+            rows, next_offset = await inline_search(key[0], key[1], INLINE_PAGE)
+        except (sqlite3.OperationalError, ValueError):
+            rows, next_offset = [], ""  # кривой синтаксис запроса/offset — пустой ответ
+        results = [r for r in map(inline_result, rows) if r is not None]
+        _inline_cache[key] = (time.monotonic(), results, next_offset)
+        while len(_inline_cache) > INLINE_CACHE_SIZE:
+            _inline_cache.popitem(last=False)
+    await iq.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
 # --- Автозапуск по ссылке ---
+TITLE_WAIT = float(os.getenv("TITLE_WAIT", "8"))  # сколько finalize ждёт незавершённый заголовок, сек.
+MEDIA_PROMPT = "Прикрепи до <b>9</b> медиа: фото, видео или GIF. Когда закончишь — нажми «Готово»."
+
+def media_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Готово", callback_data="media_done"),
+         InlineKeyboardButton(text="Сбросить медиа", callback_data="media_clear")]
+    ])
+
+class TitlePrefetch:
+    """
+    Заголовок ищется в фоне, пока пользователь собирает медиа. Задача одна на сессию FSM;
+    новая ссылка отменяет прежнюю. Результат пишется в state, только если сессия всё ещё
+    про ту же ссылку, и подставляется в сообщение-заглушку правкой на месте.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    def start(self, state: FSMContext, url: str, note: Message) -> None:
+        key = SQLiteStorage._key(state.key)
+        old = self._tasks.pop(key, None)
+        if old is not None:
+            old.cancel()
+        task = asyncio.ensure_future(self._run(state, url, note))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key, None) if self._tasks.get(key) is t else None)
+
+    async def _run(self, state: FSMContext, url: str, note: Message) -> str:
+        title = (await fetch_title_from_url(url)) or url
+        if (await state.get_data()).get("source_url") == url:
+            await state.update_data(title=title)
+        try:
+            # клавиатуру передаём заново: правка без reply_markup её убирает
+            await note.edit_text(
+                f"Нашёл заголовок: <b>{html_escape(title)}</b>\n\n{MEDIA_PROMPT}",
+                parse_mode=ParseMode.HTML,
+                reply_markup=media_kb(),
+            )
+        except (TelegramBadRequest, TelegramNetworkError) as e:
+            # сообщение удалили и т.п. — заголовок всё равно в state
+            log.warning("title placeholder edit failed in chat %s: %s", note.chat.id, e)
+        return title
+
+    async def wait(self, state: FSMContext, url: str, timeout: float = TITLE_WAIT) -> str:
+        """Заголовок для публикации: из state, из фоновой задачи или (после рестарта) заново; иначе URL."""
+        title = (await state.get_data()).get("title")
+        if title:
+            return title
+        task = self._tasks.get(SQLiteStorage._key(state.key))
+        try:
+            if task is not None:
+                title = await asyncio.wait_for(asyncio.shield(task), timeout)
+            else:
+                title = await asyncio.wait_for(fetch_title_from_url(url), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            title = None
+        return title or url
+
+    async def close(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+title_prefetch = TitlePrefetch()
+
 @router.message(AddFlow.idle, F.text.regexp(LINK_RE))
 async def on_link_auto(msg: Message, state: FSMContext):
     data = await state.get_data()
@@ -323,10 +2936,14 @@ async def on_link_auto(msg: Message, state: FSMContext):
         return
 
     url = LINK_RE.search(msg.text).group(0)
-    title = (await fetch_title_from_url(url)) or url
+    dup = await find_ref_by_url(url)
+    if dup is not None:
+        await msg.answer(duplicate_note(dup), reply_markup=reply_menu())
+        return
+
     await state.update_data(
         source_url=url,
-        title=title,
+        title=None,
         media=[],
         category=None,
         selected_tags=[],
@@ -336,19 +2953,15 @@ async def on_link_auto(msg: Message, state: FSMContext):
         prod="",
     )
 
+    # Не ждём заголовок: сразу собираем медиа, заглушку поправим, когда он найдётся.
+    # Клавиатура только inline: сообщение с обычной (reply) клавиатурой Telegram править не даёт
     await state.set_state(AddFlow.collecting_media)
-    await msg.answer(
-        f"Нашёл заголовок: <b>{title}</b>\n\nПрикрепи до <b>9</b> медиа: фото, видео или GIF. Когда закончишь — нажми «Готово».",
-        reply_markup=reply_menu(),
+    note = await msg.answer(
+        f"Ищу заголовок…\n\n{MEDIA_PROMPT}",
+        reply_markup=media_kb(),
         parse_mode=ParseMode.HTML,
     )
-    await msg.answer(
-        "Управление вложениями:",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Готово", callback_data="media_done"),
-             InlineKeyboardButton(text="Сбросить медиа", callback_data="media_clear")]
-        ])
-    )
+    title_prefetch.start(state, url, note)
 
 # --- Сбор медиа (photo / video / animation-GIF) ---
 def _append_media(state_data: dict, kind: Literal["photo","video","animation"], file_id: str) -> int:
@@ -359,26 +2972,94 @@ def _append_media(state_data: dict, kind: Literal["photo","video","animation"],
     state_data["media"] = media
     return len(media)
 
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "0.8"))  # тишина после последнего элемента альбома, сек.
+
+class MediaGroupAggregator:
+    """
+    Альбом Telegram приходит отдельными апдейтами. Копим их по media_group_id, пока элементы идут
+    (окно ALBUM_WINDOW от последнего), затем добавляем весь альбом одним обновлением состояния
+    в пределах лимита 9 и отвечаем одним сообщением. Одиночные вложения добавляются сразу.
+    Добавление идёт под замком сессии, поэтому параллельные апдейты не затирают список медиа.
+    close() при остановке сразу сбрасывает недокопленные альбомы и дожидается их записи.
+    """
+
+    def __init__(self, window: float = ALBUM_WINDOW):
+        self.window = window
+        self._albums: Dict[Tuple[int, int, str], Dict[str, Any]] = {}
+        self._locks: "weakref.WeakValueDictionary[Tuple[int, int], asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._tasks: set = set()
+
+    async def add(self, msg: Message, state: FSMContext, kind: Literal["photo","video","animation"], file_id: str):
+        if not msg.media_group_id:
+            await self._commit(msg, state, [(kind, file_id, image_ref(msg))])
+            return
+        key = (msg.chat.id, msg.from_user.id, msg.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = {"items": [], "timer": None, "msg": msg, "state": state}
+        album["items"].append((msg.message_id, kind, file_id, image_ref(msg)))
+        if album["timer"] is not None:
+            album["timer"].cancel()
+        album["timer"] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    async def close(self) -> None:
+        for key in list(self._albums):
+            self._albums[key]["timer"].cancel()
+            self._flush(key)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _flush(self, key: Tuple[int, int, str]) -> None:
+        album = self._albums.pop(key)
+        items = [item[1:] for item in sorted(album["items"], key=lambda item: item[0])]
+        task = asyncio.ensure_future(self._commit(album["msg"], album["state"], items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _lock(self, msg: Message) -> asyncio.Lock:
+        key = (msg.chat.id, msg.from_user.id)
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        return lock
+
+    async def _commit(self, msg: Message, state: FSMContext,
+                      items: List[Tuple[str, str, Optional[Tuple[str, str]]]]) -> None:
+        async with self._lock(msg):
+            current = await state.get_state()
+            if current != AddFlow.collecting_media.state:
+                # пока копился альбом, пользователь ушёл дальше (Готово/Стоп)
+                log.info("album of %d items dropped: chat %s moved to %s", len(items), msg.chat.id, current)
+                await msg.answer("Эти вложения не добавлены: сбор медиа уже завершён.")
+                return
+            data = await state.get_data()
+            before = len(data.get("media", []))
+            new_len = before
+            added = []
+            for kind, fid, pic in items:
+                if _append_media(data, kind, fid) > new_len:
+                    new_len += 1
+                    if pic:
+                        added.append((fid, pic))
+            await state.update_data(media=data.get("media", []))
+        image_index.watch(msg.chat.id, added)
+        if new_len - before < len(items):
+            await msg.answer(f"Добавлено: {new_len}/9. Лимит 9 — остальное не поместилось, нажми «Готово».")
+        else:
+            await msg.answer(f"Добавлено: {new_len}/9.")
+
+media_groups = MediaGroupAggregator()
+
 @router.message(AddFlow.collecting_media, F.photo)
 async def on_photo(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    new_len = _append_media(data, "photo", msg.photo[-1].file_id)
-    await state.update_data(**data)
-    await msg.answer("Лимит 9. Нажми «Готово»." if new_len > 9 else f"Добавлено: {new_len}/9.")
+    await media_groups.add(msg, state, "photo", msg.photo[-1].file_id)
 
 @router.message(AddFlow.collecting_media, F.video)
 async def on_video(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    new_len = _append_media(data, "video", msg.video.file_id)
-    await state.update_data(**data)
-    await msg.answer(f"Добавлено: {new_len}/9.")
+    await media_groups.add(msg, state, "video", msg.video.file_id)
 
 @router.message(AddFlow.collecting_media, F.animation)
 async def on_animation(msg: Message, state: FSMContext):
-    data = await state.get_data()
-    new_len = _append_media(data, "animation", msg.animation.file_id)
-    await state.update_data(**data)
-    await msg.answer(f"Добавлено: {new_len}/9.")
+    await media_groups.add(msg, state, "animation", msg.animation.file_id)
 
 @router.callback_query(AddFlow.collecting_media, F.data == "media_clear")
 async def on_media_clear(cb: CallbackQuery, state: FSMContext):
@@ -510,7 +3191,6 @@ async def got_prod(msg: Message, state: FSMContext, bot: Bot):
 async def finalize_and_post(msg_or_cb_message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     url: str = data.get("source_url", "")
-    title: str = data.get("title") or url
     media: List[Dict[str, str]] = data.get("media", [])
     category: str = data.get("category", "misc")
     tags: List[str] = data.get("selected_tags", [])
@@ -525,78 +3205,810 @@ async def finalize_and_post(msg_or_cb_message: Message, state: FSMContext, bot:
         await state.set_state(AddFlow.idle)
         return
 
-    title_line = html_link_title(title, url)
-
-    credits_lines = []
-    if dir_:  credits_lines.append(f"dir: {dir_}")
-    if dop:   credits_lines.append(f"dop: {dop}")
-    if color: credits_lines.append(f"color: {color}")
-    if prod:  credits_lines.append(f"prod: {prod}")
-
-    parts = [title_line]
-    if credits_lines:
-        parts.append("\n".join(credits_lines))
-    if category or tags:
-        parts.append(hashtags(category, tags))
-
-    cap = "\n\n".join(parts).strip()
-
-    # Собираем смешанный медиа-альбом
-    items = []
-    for idx, m in enumerate(media):
-        t, fid = m["type"], m["file_id"]
-        if idx == 0:
-            if t == "photo":
-                items.append(InputMediaPhoto(media=fid, caption=cap, parse_mode=ParseMode.HTML))
-            elif t == "video":
-                items.append(InputMediaVideo(media=fid, caption=cap, parse_mode=ParseMode.HTML))
-            else:
-                items.append(InputMediaAnimation(media=fid, caption=cap, parse_mode=ParseMode.HTML))
-        else:
-            if t == "photo":
-                items.append(InputMediaPhoto(media=fid))
-            elif t == "video":
-                items.append(InputMediaVideo(media=fid))
-            else:
-                items.append(InputMediaAnimation(media=fid))
-
-    try:
-        msgs = await bot.send_media_group(chat_id=CHANNEL_ID, media=items)
-        first_id = msgs[0].message_id if msgs else None
-    except Exception:
-        await msg_or_cb_message.answer("Не удалось опубликовать в канал. Проверь права бота и CHANNEL_ID.")
+    dup = await find_ref_by_url(url)
+    if dup is not None:
+        await msg_or_cb_message.answer(duplicate_note(dup), reply_markup=reply_menu())
+        await state.clear()
+        await state.set_state(AddFlow.idle)
         return
 
-    insert_reference(
-        source_url=url,
-        title=title,
-        category=category,
-        tags=tags,
+    title: str = data.get("title") or await title_prefetch.wait(state, url)
+    cap = build_caption(title, url, category, tags, dir_, dop, color, prod)
+
+    # Публикует воркер очереди (лимиты, RetryAfter, повторы); в refs пишет после отправки
+    await publisher.enqueue(
+        chat_id=CHANNEL_ID,
+        reply_chat_id=msg_or_cb_message.chat.id,
+        caption=cap,
         media=media,
-        channel_message_id=first_id,
-        dir_=dir_,
-        dop=dop,
-        color=color,
-        prod=prod,
+        ref=dict(source_url=url, title=title, category=category, tags=tags,
+                 dir_=dir_, dop=dop, color=color, prod=prod),
     )
 
-    await msg_or_cb_message.answer("Готово! Пост опубликован в канале ✅", reply_markup=reply_menu())
+    await msg_or_cb_message.answer("Пост в очереди на публикацию ⏳ Напишу, когда выйдет.", reply_markup=reply_menu())
     await state.clear()
     await state.set_state(AddFlow.idle)
 
 # ---------- MAIN ----------
+# ---- Webhook (вместо long polling, если задан WEBHOOK_BASE_URL) ----
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "")              # https://bot.example.com (за reverse proxy)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")                  # X-Telegram-Bot-Api-Secret-Token; пусто — из токена
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))   # апдейтов в обработке одновременно
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "25"))
+
+class UpdateLimiter(BaseMiddleware):
+    """Ограничивает число одновременно обрабатываемых апдейтов и умеет дождаться, пока все допишутся."""
+
+    def __init__(self, limit: int = UPDATE_CONCURRENCY):
+        self._sem = asyncio.Semaphore(limit)
+        self._inflight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self._inflight += 1
+        self._idle.clear()
+        metrics.set("refbot_updates_inflight", self._inflight)
+        try:
+            async with self._sem:
+                return await handler(event, data)
+        finally:
+            self._inflight -= 1
+            metrics.set("refbot_updates_inflight", self._inflight)
+            if not self._inflight:
+                self._idle.set()
+
+    async def drain(self, timeout: float = SHUTDOWN_DRAIN_TIMEOUT) -> None:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            log.warning("shutdown: %d updates still running, giving up", self._inflight)
+
+update_limiter = UpdateLimiter()
+
+def webhook_secret(token: str) -> str:
+    """Детерминированный секрет из токена: сам токен в заголовок не попадает, а у всех процессов он общий."""
+    return hashlib.sha256(b"refbot-webhook:" + token.encode()).hexdigest()
+
+async def run_webhook(bot: Bot, dp: Dispatcher) -> None:
+    # Без секрета апдейты мог бы подкинуть любой, кто знает URL. Секрет один на все экземпляры бота
+    # (несколько реплик, rolling deploy): каждый set_webhook ставит тот же, и старые процессы не ловят 401
+    secret = WEBHOOK_SECRET or webhook_secret(bot.token)
+    app = web.Application()
+    handler = SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret,                  # чужой/пустой заголовок -> 401
+        handle_in_background=True,            # Telegram получает 200 сразу, апдейт идёт в фоне
+    )
+    # Без handler.register(): он закрывает сессию бота раньше, чем допишется очередь публикаций
+    app.router.add_post(WEBHOOK_PATH, handler.handle)
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    await bot.set_webhook(
+        WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(UPDATE_CONCURRENCY, 100),
+    )
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    log.info("webhook on %s:%d%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        await site.stop()              # новые апдейты не принимаем (Telegram повторит их позже)
+        await update_limiter.drain()   # принятые — дописываем
+        await runner.cleanup()
+
+def build_dispatcher() -> Dispatcher:
+    dp = Dispatcher(storage=fsm_storage)
+    dp.update.outer_middleware(update_limiter)
+    dp.update.outer_middleware(update_timer)
+    for observer in (dp.message, dp.callback_query, dp.inline_query):
+        observer.middleware(handler_timer)
+    dp.include_router(router)
+    return dp
+
+async def start_services(bot: Bot) -> None:
+    """БД и фоновые службы бота; парный stop_services(). Используется и в bench.py."""
+    bot.session.middleware(api_timer)
+    init_db()
+    await http_client.start()
+    await ytdlp_pool.start()
+    fsm_storage.start()
+    await publisher.start(bot)
+    image_index.start(bot)
+    await media_archive.start(bot)
+    profiler.start()
+
+async def stop_services(bot: Bot) -> None:
+    profiler.stop()
+    await media_groups.close()  # до FSM-хранилища и сессии бота: альбомам нужны оба
+    await title_prefetch.close()
+    await image_index.close()
+    await media_archive.close()
+    await publisher.close()
+    await ytdlp_pool.close()
+    await http_client.close()
+    await fsm_storage.close()
+    strategy_router.flush()
+    await db.close()
+    await bot.session.close()
+
 async def main():
     if not BOT_TOKEN:
         raise SystemExit("Set TELEGRAM_BOT_TOKEN env var")
     bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = build_dispatcher()
+    await start_services(bot)
+    metrics_runner = await start_metrics_server()
+    log.info("Bot is running…")
+    try:
+        if WEBHOOK_BASE_URL:
+            await run_webhook(bot, dp)
+        else:
+            await bot.delete_webhook()  # на случай переключения с webhook обратно
+            await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await update_limiter.drain()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await stop_services(bot)
+
+# ---------- BACKFILL: python main.py backfill FILE ----------
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "16"))  # одновременных резолвов заголовка
+BACKFILL_CHUNK = int(os.getenv("BACKFILL_CHUNK", "500"))     # строк на транзакцию (+ checkpoint)
+BACKFILL_SHOW_FAILURES = 50
+
+def read_backfill_rows(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    CSV с заголовком или JSONL. Поля: url (или source_url) + необязательные title, category,
+    tags ('a,b' / '#a #b' / список), dir, dop, color, prod, media (JSON-список как в refs.media_json).
+    Одна строка файла — один элемент, пустые строки тоже (номер строки = позиция для checkpoint).
+    """
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    yield {}
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield {"_error": f"bad JSON: {e}"}
+    else:
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            yield from csv.DictReader(f)
+
+def backfill_item(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Строка файла -> поля refs; ValueError, если строку импортировать нельзя."""
+    if row.get("_error"):
+        raise ValueError(row["_error"])
+    m = LINK_RE.search(str(row.get("url") or row.get("source_url") or ""))
+    if not m:
+        raise ValueError("no URL")
+    tags = row.get("tags") or []
+    if isinstance(tags, str):
+        tags = re.split(r"[\s,;#]+", tags)
+    media = row.get("media") or []
+    if isinstance(media, str):
+        media = json.loads(media)
+    return dict(
+        source_url=m.group(0),
+        title=str(row.get("title") or "").strip(),
+        category=str(row.get("category") or "").strip().lstrip("#").lower() or "misc",
+        tags=parse_tags(",".join(str(t) for t in tags)),
+        dir_=str(row.get("dir") or "").strip(),
+        dop=str(row.get("dop") or "").strip(),
+        color=str(row.get("color") or "").strip(),
+        prod=str(row.get("prod") or "").strip(),
+        media=media[:9],
+    )
+
+class Backfill:
+    """
+    Импорт пачками по BACKFILL_CHUNK строк: дубли отсеиваются по canonical_url до сетевых запросов,
+    заголовки резолвятся параллельно (workers; лимит на хост — у http_client), затем вся пачка
+    и checkpoint пишутся одной транзакцией. С --publish строки только ставятся в publish_jobs:
+    публикует запущенный бот своими воркерами (его лимиты), refs заполняется после отправки.
+    """
+
+    def __init__(self, path: str, workers: int, chunk: int, publish: bool, restart: bool):
+        self.path = path
+        self.name = f"backfill:{os.path.abspath(path)}"
+        self.workers = max(1, workers)
+        self.chunk = max(1, chunk)
+        self.publish = publish
+        self.restart = restart
+        self.seen: set = set()
+        self.stats = {"rows": 0, "added": 0, "duplicates": 0, "untitled": 0}
+        self.failures: List[Tuple[int, str, str]] = []
+
+    async def run(self) -> None:
+        start_line = 0
+        if not self.restart:
+            start_line = ((await db.read(lambda conn: load_checkpoint(conn, self.name))) or {}).get("line", 0)
+        if start_line:
+            print(f"Продолжаю с checkpoint: запись {start_line + 1}")
+        sem = asyncio.Semaphore(self.workers)
+        started = time.monotonic()
+        batch: List[Tuple[int, Dict[str, Any]]] = []
+        line = 0
+        for line, row in enumerate(read_backfill_rows(self.path), 1):
+            if line <= start_line:
+                continue
+            batch.append((line, row))
+            if len(batch) >= self.chunk:
+                await self._process(batch, line, sem)
+                batch = []
+                self._progress(started)
+        if line > start_line:
+            await self._process(batch, line, sem)
+        self._report(started)
+
+    async def _process(self, batch: List[Tuple[int, Dict[str, Any]]], last_line: int, sem: asyncio.Semaphore) -> None:
+        items: List[Tuple[int, Dict[str, Any]]] = []
+        for line, row in batch:
+            if not row:
+                continue
+            self.stats["rows"] += 1
+            try:
+                item = backfill_item(row)
+                key = canonical_url(item["source_url"])
+            except (ValueError, TypeError) as e:
+                self.failures.append((line, str(row)[:80], str(e)))
+                continue
+            if key in self.seen:
+                self.stats["duplicates"] += 1
+                continue
+            self.seen.add(key)
+            items.append((line, item))
+
+        keys = [canonical_url(item["source_url"]) for _, item in items]
+
+        def _known(conn: sqlite3.Connection) -> set:
+            found = set()
+            for i in range(0, len(keys), 500):  # лимит параметров SQLite
+                part = keys[i:i + 500]
+                found.update(k for (k,) in conn.execute(
+                    f"SELECT canonical_url FROM refs WHERE canonical_url IN ({','.join('?' * len(part))})", part,
+                ))
+            return found
+
+        known = await db.read(_known)
+        self.stats["duplicates"] += sum(k in known for k in keys)
+        items = [(line, item) for (line, item), k in zip(items, keys) if k not in known]
+
+        async def resolve(line: int, item: Dict[str, Any]) -> None:
+            if item["title"]:
+                return
+            async with sem:
+                try:
+                    title = await fetch_title_from_url(item["source_url"])
+                except Exception as e:  # резолвер сам гасит ошибки стратегий; это — на всякий случай
+                    self.failures.append((line, item["source_url"], repr(e)))
+                    title = ""
+            if not title:
+                self.stats["untitled"] += 1
+            item["title"] = title or item["source_url"]
+
+        await asyncio.gather(*(resolve(line, item) for line, item in items))
+        self.stats["added"] += await db.write(lambda conn: self._commit(conn, [item for _, item in items], last_line))
+
+    def _commit(self, conn: sqlite3.Connection, items: List[Dict[str, Any]], last_line: int) -> int:
+        added = 0
+        for item in items:
+            key = canonical_url(item["source_url"])
+            if conn.execute("SELECT 1 FROM refs WHERE canonical_url=?", (key,)).fetchone():
+                self.stats["duplicates"] += 1  # появился, пока резолвили
+                continue
+            ref = {k: v for k, v in item.items() if k != "media"}
+            if self.publish:
+                cap = build_caption(ref["title"], ref["source_url"], ref["category"], ref["tags"],
+                                    ref["dir_"], ref["dop"], ref["color"], ref["prod"])
+                Publisher.insert_job(conn, CHANNEL_ID, None, cap, item["media"], ref)
+            else:
+                _insert_reference(conn, channel_message_id=None, media=item["media"], **ref)
+            added += 1
+        save_checkpoint(conn, self.name, {"line": last_line})
+        return added
+
+    def _progress(self, started: float) -> None:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        print(f"  {self.stats['rows']} строк, {self.stats['rows'] / elapsed:.1f} ссылок/с")
+
+    def _report(self, started: float) -> None:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        s = self.stats
+        verb = "в очередь публикации" if self.publish else "добавлено"
+        print(
+            f"Готово за {elapsed:.1f} с: {s['rows']} строк ({s['rows'] / elapsed:.1f} ссылок/с); "
+            f"{verb}: {s['added']}, дублей: {s['duplicates']}, без заголовка: {s['untitled']}, "
+            f"ошибок: {len(self.failures)}"
+        )
+        for line, what, error in self.failures[:BACKFILL_SHOW_FAILURES]:
+            print(f"  запись {line}: {what} — {error}", file=sys.stderr)
+        if len(self.failures) > BACKFILL_SHOW_FAILURES:
+            print(f"  … и ещё {len(self.failures) - BACKFILL_SHOW_FAILURES}", file=sys.stderr)
+
+async def backfill(path: str, workers: int, per_host: int, chunk: int, publish: bool, restart: bool) -> None:
+    # Своих воркеров публикации здесь нет: второй Publisher вернул бы в очередь задания, которые
+    # бот отправляет прямо сейчас (дубли в канале), и удвоил бы лимиты канала
+    if publish and not os.getenv("TELEGRAM_CHANNEL_ID"):
+        raise SystemExit("--publish: set TELEGRAM_CHANNEL_ID")
     init_db()
-    dp = Dispatcher()
-    dp.include_router(router)
-    print("Bot is running…")
-    await dp.start_polling(bot)
+    http_client.per_host = per_host
+    await http_client.start()
+    await ytdlp_pool.start()
+    try:
+        await Backfill(path, workers, chunk, publish, restart).run()
+        if publish:
+            print("Задания в publish_jobs — их опубликует запущенный бот")
+    finally:
+        await ytdlp_pool.close()
+        await http_client.close()
+        strategy_router.flush()
+        await db.close()
 
-if __name__ == "__main__":
+# ---------- RECAPTION: python main.py recaption ----------
+RECAPTION_RATE = float(os.getenv("RECAPTION_RATE", "20"))   # правок/мин в канал (лимит как у публикаций)
+RECAPTION_BURST = float(os.getenv("RECAPTION_BURST", "5"))
+RECAPTION_BATCH = 200                                       # строк refs на одно чтение
+RECAPTION_MAX_ATTEMPTS = 5                                  # сетевые/5xx ошибки на один пост
+RECAPTION_CHECKPOINT = "recaption"
+
+def renamed(category: Optional[str], raw_tags: Optional[str]) -> Tuple[Optional[str], List[str]]:
+    tags = list(dict.fromkeys(TAG_RENAMES.get(t, t) for t in parse_tags(raw_tags)))
+    return CATEGORY_RENAMES.get(category, category), tags
+
+def apply_renames(conn: sqlite3.Connection) -> int:
+    """CATEGORY_RENAMES/TAG_RENAMES -> refs (+ ref_tags/маска; FTS — триггерами). Повторный вызов — no-op."""
+    if not (CATEGORY_RENAMES or TAG_RENAMES):
+        return 0
+    cats, tags = list(CATEGORY_RENAMES), list(TAG_RENAMES)
+    rows = conn.execute(
+        f"SELECT id, category, tags FROM refs WHERE category IN ({','.join('?' * len(cats))}) "
+        f"OR id IN (SELECT ref_id FROM ref_tags WHERE tag IN ({','.join('?' * len(tags))}))",
+        cats + tags,
+    ).fetchall()
+    for ref_id, category, raw in rows:
+        new_category, new_tags = renamed(category, raw)
+        conn.execute("UPDATE refs SET category=?, tags=? WHERE id=?", (new_category, ",".join(new_tags), ref_id))
+        conn.execute("DELETE FROM ref_tags WHERE ref_id=?", (ref_id,))
+        _store_ref_tags(conn, ref_id, new_tags)
+    return len(rows)
+
+class Recaption:
+    """
+    Пересборка подписей опубликованных постов по refs (после правок CATEGORIES/TAG_GROUPS).
+    Идём по id пачками; пост, у которого хэш новой подписи совпал с caption_hash, пропускаем без
+    запросов. Правки — через токен-бакет, RetryAfter выдерживаем ровно; хэш и checkpoint пишутся
+    одной транзакцией после каждой правки, так что прерванный прогон продолжается с места.
+    """
+
+    def __init__(self, bot: Optional[Bot], chat_id: str, rate: float, restart: bool, dry_run: bool):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(rate / 60, RECAPTION_BURST)
+        self.restart = restart
+        self.dry_run = dry_run
+        self.stats = {"posts": 0, "unchanged": 0, "edited": 0}
+        self.failures: List[Tuple[int, str]] = []
+
+    async def run(self) -> None:
+        if not self.dry_run:
+            await db.write(seed_caption_hashes)  # посты, добавленные мимо очереди, — до переименований
+            n_renamed = await db.write(apply_renames)
+            if n_renamed:
+                print(f"Переименования применены к {n_renamed} записям")
+        last_id = 0
+        if not (self.restart or self.dry_run):
+            last_id = ((await db.read(lambda conn: load_checkpoint(conn, RECAPTION_CHECKPOINT))) or {}).get("id", 0)
+        if last_id:
+            print(f"Продолжаю с checkpoint: id > {last_id}")
+        started = time.monotonic()
+        while True:
+            rows = await db.read(lambda conn: conn.execute(
+                "SELECT id, title, source_url, category, tags, dir, dop, color, prod, "
+                "channel_message_id, media_json, caption_hash FROM refs "
+                "WHERE id > ? AND channel_message_id IS NOT NULL ORDER BY id LIMIT ?",
+                (last_id, RECAPTION_BATCH),
+            ).fetchall())
+            if not rows:
+                break
+            for row in rows:
+                await self._one(row)
+            last_id = rows[-1][0]
+            if not self.dry_run:
+                await db.write(lambda conn: save_checkpoint(conn, RECAPTION_CHECKPOINT, {"id": last_id}))
+            self._progress(started)
+        if not self.dry_run:
+            # прошли до конца: следующая смена таксономии начнёт с первого поста
+            await db.write(lambda conn: save_checkpoint(conn, RECAPTION_CHECKPOINT, {"id": 0}))
+        self._report(started)
+
+    async def _one(self, row: Tuple) -> None:
+        ref_id, title, url, category, tags, dir_, dop, color, prod, message_id, media_json, old_hash = row
+        self.stats["posts"] += 1
+        if old_hash is None:  # --dry-run не пишет: неизвестный хэш — как у seed_caption_hashes
+            old_hash = caption_hash(ref_caption(title, url, category, tags, dir_, dop, color, prod))
+        category, tag_list = renamed(category, tags)  # для --dry-run, где refs ещё не переименованы
+        cap = ref_caption(title, url, category, ",".join(tag_list), dir_, dop, color, prod)
+        new_hash = caption_hash(cap)
+        if new_hash == old_hash:
+            self.stats["unchanged"] += 1
+            return
+        if self.dry_run:
+            self.stats["edited"] += 1
+            return
+        attempts = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                if json.loads(media_json or "[]"):
+                    await self.bot.edit_message_caption(
+                        chat_id=self.chat_id, message_id=message_id, caption=cap, parse_mode=ParseMode.HTML,
+                    )
+                else:
+                    await self.bot.edit_message_text(
+                        text=cap, chat_id=self.chat_id, message_id=message_id, parse_mode=ParseMode.HTML,
+                    )
+                break
+            except TelegramRetryAfter as e:
+                self.bucket.block(e.retry_after)
+            except TelegramBadRequest as e:
+                if "not modified" in str(e):  # в канале уже эта подпись
+                    break
+                self.failures.append((ref_id, str(e)))
+                return
+            except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+                attempts += 1
+                if attempts >= RECAPTION_MAX_ATTEMPTS:
+                    self.failures.append((ref_id, str(e)))
+                    return
+                await asyncio.sleep(min(2 ** attempts, PUBLISH_BACKOFF_MAX) * (1 + random.random() / 2))
+
+        def _done(conn: sqlite3.Connection) -> None:
+            conn.execute("UPDATE refs SET caption_hash=? WHERE id=?", (new_hash, ref_id))
+            save_checkpoint(conn, RECAPTION_CHECKPOINT, {"id": ref_id})
+
+        await db.write(_done)
+        self.stats["edited"] += 1
+
+    def _progress(self, started: float) -> None:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        s = self.stats
+        print(f"  {s['posts']} постов, изменено: {s['edited']}, без изменений: {s['unchanged']} "
+              f"({s['posts'] / elapsed:.1f} постов/с)")
+
+    def _report(self, started: float) -> None:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        s = self.stats
+        verb = "к правке" if self.dry_run else "изменено"
+        print(
+            f"Готово за {elapsed:.1f} с: {s['posts']} постов; {verb}: {s['edited']}, "
+            f"без изменений: {s['unchanged']}, ошибок: {len(self.failures)}"
+        )
+        for ref_id, error in self.failures[:BACKFILL_SHOW_FAILURES]:
+            print(f"  ref {ref_id}: {error}", file=sys.stderr)
+        if len(self.failures) > BACKFILL_SHOW_FAILURES:
+            print(f"  … и ещё {len(self.failures) - BACKFILL_SHOW_FAILURES}", file=sys.stderr)
+
+async def recaption(rate: float, restart: bool, dry_run: bool) -> None:
+    if not dry_run and not (BOT_TOKEN and CHANNEL_ID):
+        raise SystemExit("recaption: set TELEGRAM_BOT_TOKEN and TELEGRAM_CHANNEL_ID (or use --dry-run)")
+    init_db()
+    bot = None if dry_run else Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    try:
+        await Recaption(bot, CHANNEL_ID, rate, restart, dry_run).run()
+    finally:
+        await db.close()
+        if bot is not None:
+            await bot.session.close()
+
+# ---------- EXPORT / API: python main.py export FILE | python main.py api ----------
+# Обе команды открывают базу только на чтение (mode=ro) и работают рядом с запущенным ботом.
+# Строки идут keyset-пачками по id: каждая пачка — короткая транзакция чтения, память не растёт.
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+EXPORT_CSV_FIELDS = [
+    "id", "url", "title", "category", "tags", "dir", "dop", "color", "prod",
+    "channel_message_id", "post_url", "created_at", "media_types", "media_file_ids", "media_sha256",
+]
+API_HOST = os.getenv("API_HOST", "127.0.0.1")
+API_PORT = int(os.getenv("API_PORT", "8090"))
+API_PAGE = 50
+API_PAGE_MAX = 200
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", "30"))   # сек.; новые посты видны с этой задержкой
+API_CACHE_SIZE = 512
+
+RECORD_COLUMNS = (
+    "r.id, r.source_url, r.title, r.category, r.tags, r.dir, r.dop, r.color, r.prod, "
+    "r.channel_message_id, r.media_json, r.created_at"
+)
+
+def ref_records(conn: sqlite3.Connection, sql: str, args: List[Any]) -> List[Dict[str, Any]]:
+    """Строки RECORD_COLUMNS -> словари с развёрнутыми тегами/медиа (+ sha256 файла из архива, если скачан)."""
+    rows = conn.execute(sql, args).fetchall()
+    media = {row[0]: json.loads(row[10] or "[]") for row in rows}
+    file_ids = [m["file_id"] for items in media.values() for m in items]
+    archived: Dict[str, str] = {}
+    for i in range(0, len(file_ids), 500):  # лимит параметров SQLite
+        part = file_ids[i:i + 500]
+        archived.update(conn.execute(
+            f"SELECT file_id, sha256 FROM media_archive WHERE status='done' AND file_id IN ({','.join('?' * len(part))})",
+            part,
+        ))
+    return [
+        {
+            "id": ref_id,
+            "url": url,
+            "title": title or url,
+            "category": category or "",
+            "tags": parse_tags(tags),
+            "credits": {"dir": dir_ or "", "dop": dop or "", "color": color or "", "prod": prod or ""},
+            "channel_message_id": message_id,
+            "post_url": channel_post_link(message_id),
+            "media": [
+                {"type": m["type"], "file_id": m["file_id"], "sha256": archived.get(m["file_id"])}
+                for m in media[ref_id]
+            ],
+            "created_at": created_at,
+        }
+        for ref_id, url, title, category, tags, dir_, dop, color, prod, message_id, _, created_at in rows
+    ]
+
+def csv_record(rec: Dict[str, Any]) -> Dict[str, Any]:
+    """Плоская строка CSV; url/title/category/tags/кредиты читает и backfill."""
+    return {
+        **{k: rec[k] for k in ("id", "url", "title", "category", "channel_message_id", "post_url", "created_at")},
+        **rec["credits"],
+        "tags": ",".join(rec["tags"]),
+        "media_types": ",".join(m["type"] for m in rec["media"]),
+        "media_file_ids": ",".join(m["file_id"] for m in rec["media"]),
+        "media_sha256": ",".join(m["sha256"] or "" for m in rec["media"]),
+    }
+
+async def open_readonly_db() -> None:
+    if not os.path.exists(DB_PATH):
+        raise SystemExit(f"{DB_PATH}: no such database")
+    db.open(DB_PATH, readonly=True)
+    version = await db.read(lambda conn: conn.execute("PRAGMA user_version").fetchone()[0])
+    if version < len(MIGRATIONS):
+        await db.close()
+        raise SystemExit(f"{DB_PATH}: old schema ({version} < {len(MIGRATIONS)}), start the bot once to migrate")
+    TAG_BITS.update(await db.read(lambda conn: dict(conn.execute("SELECT tag, bit FROM tag_bits"))))
+
+async def export(path: str, fmt: str, batch: int) -> None:
+    await open_readonly_db()
+    out = sys.stdout if path == "-" else open(path, "w", encoding="utf-8", newline="")
+    try:
+        writer = csv.DictWriter(out, EXPORT_CSV_FIELDS) if fmt == "csv" else None
+        if writer is not None:
+            writer.writeheader()
+        after, total, started = 0, 0, time.monotonic()
+        while True:
+            records = await db.read(lambda conn: ref_records(
+                conn, f"SELECT {RECORD_COLUMNS} FROM refs r WHERE r.id > ? ORDER BY r.id LIMIT ?", [after, batch],
+            ))
+            if not records:
+                break
+            for rec in records:
+                if writer is not None:
+                    writer.writerow(csv_record(rec))
+                else:
+                    out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            after = records[-1]["id"]
+            total += len(records)
+        print(f"Выгружено {total} постов за {time.monotonic() - started:.1f} с", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        await db.close()
+
+def _api_date(value: str, end: bool = False) -> str:
+    """
+    '2024-05-01' или ISO-время -> граница для created_at (наивное ISO в UTC, как пишет _insert_reference).
+    Время с зоной (+03:00, Z) переводится в UTC; без зоны считается UTC. Конец дня включается.
+    """
+    value = re.sub(r" (\d\d:?\d\d)$", r"+\1", value.strip())  # '+' в query без кодирования приходит пробелом
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"bad date: {value!r}, expected ISO 8601 (2024-05-01 or 2024-05-01T10:00:00+03:00)")
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if end and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed.isoformat()
+
+def api_query(params: "web.MultiDictProxy") -> Tuple[str, List[Any], int]:
+    """
+    Фильтры /refs -> SQL по индексам: category (refs_category_mask), tag — все из списка (маска/ref_tags),
+    since/until (refs_created_at), credits — FTS по dir/dop/color/prod. Свежие первыми; after=id — следующая страница.
+    ValueError — неверный параметр.
+    """
+    where: List[str] = []
+    args: List[Any] = []
+    category = params.get("category", "").strip().lstrip("#")
+    if category:
+        where.append("r.category = ?")
+        args.append(category)
+    tags = parse_tags(",".join(params.getall("tag", [])).replace("#", ""))
+    tag_where, tag_args = tag_filter_sql(tags, [])
+    where += tag_where
+    args += tag_args
+    if params.get("since"):
+        where.append("r.created_at >= ?")
+        args.append(_api_date(params["since"]))
+    if params.get("until"):
+        where.append("r.created_at < ?")
+        args.append(_api_date(params["until"], end=True))
+    terms = [w.replace('"', '""') for w in params.get("credits", "").split() if w.strip('"')]
+    if terms:
+        where.append("r.id IN (SELECT rowid FROM refs_fts WHERE refs_fts MATCH ?)")
+        args.append(" AND ".join(f'{{dir dop color prod}} : "{t}"*' for t in terms))
+    if params.get("after"):
+        where.append("r.id < ?")
+        args.append(int(params["after"]))
+    limit = min(max(int(params.get("limit") or API_PAGE), 1), API_PAGE_MAX)
+    sql = f"SELECT {RECORD_COLUMNS} FROM refs r"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY r.id DESC LIMIT ?"
+    return sql, args + [limit + 1], limit
+
+class ResponseCache:
+    """Готовые JSON-ответы API по нормализованному запросу: TTL + LRU."""
+
+    def __init__(self, ttl: float = API_CACHE_TTL, size: int = API_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._items: "OrderedDict[str, Tuple[float, bytes, str]]" = OrderedDict()  # -> (expires, body, etag)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        item = self._items.get(key)
+        if item is None or item[0] < time.monotonic():
+            metrics.inc("refbot_api_cache_total", result="miss")
+            return None
+        self._items.move_to_end(key)
+        metrics.inc("refbot_api_cache_total", result="hit")
+        return item[1], item[2]
+
+    def put(self, key: str, body: bytes) -> Tuple[bytes, str]:
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        self._items[key] = (time.monotonic() + self.ttl, body, etag)
+        self._items.move_to_end(key)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+        return body, etag
+
+def build_api_app() -> web.Application:
+    cache = ResponseCache()
+
+    async def respond(request: web.Request, load: Callable[[], Awaitable[Any]]) -> web.Response:
+        key = request.path + "?" + urlencode(sorted(request.query.items()))
+        hit = cache.get(key)
+        if hit is None:
+            try:
+                result = await load()
+            except ValueError as e:
+                return web.json_response({"error": str(e)}, status=400)
+            if result is None:
+                return web.json_response({"error": "not found"}, status=404)
+            hit = cache.put(key, json.dumps(result, ensure_ascii=False).encode())
+        body, etag = hit
+        headers = {"ETag": etag, "Cache-Control": f"max-age={int(cache.ttl)}"}
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+    async def list_refs(request: web.Request) -> web.Response:
+        async def load() -> Dict[str, Any]:
+            sql, args, limit = api_query(request.query)
+            items = await db.read(lambda conn: ref_records(conn, sql, args))
+            more = len(items) > limit
+            items = items[:limit]
+            return {"items": items, "next": str(items[-1]["id"]) if more else None}
+
+        with metrics.timer("refbot_api_seconds", route="refs"):
+            return await respond(request, load)
+
+    async def get_ref(request: web.Request) -> web.Response:
+        async def load() -> Optional[Dict[str, Any]]:
+            ref_id = int(request.match_info["ref_id"])
+            items = await db.read(lambda conn: ref_records(
+                conn, f"SELECT {RECORD_COLUMNS} FROM refs r WHERE r.id = ?", [ref_id],
+            ))
+            return items[0] if items else None
+
+        with metrics.timer("refbot_api_seconds", route="ref"):
+            return await respond(request, load)
+
+    app = web.Application()
+    app.router.add_get("/refs", list_refs)
+    app.router.add_get(r"/refs/{ref_id:\d+}", get_ref)
+    return app
+
+async def serve_api(host: str, port: int) -> None:
+    await open_readonly_db()
+    runner = web.AppRunner(build_api_app(), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        log.info("read-only API on http://%s:%d/refs", host, port)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        await db.close()
+
+def cli(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Бот референсов и обслуживающие команды.")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("bot", help="запустить бота (по умолчанию)")
+    p = sub.add_parser("backfill", help="импорт ссылок из CSV/JSONL (с продолжением по checkpoint)")
+    p.add_argument("file")
+    p.add_argument("--workers", type=int, default=BACKFILL_WORKERS, help="одновременных резолвов заголовка")
+    p.add_argument("--per-host", type=int, default=HTTP_PER_HOST, help="одновременных HTTP-запросов на хост")
+    p.add_argument("--chunk", type=int, default=BACKFILL_CHUNK, help="строк на транзакцию")
+    p.add_argument("--publish", action="store_true", help="поставить в очередь публикации запущенного бота")
+    p.add_argument("--restart", action="store_true", help="игнорировать checkpoint и начать с начала")
+    p = sub.add_parser("recaption", help="пересобрать подписи постов в канале после переименований")
+    p.add_argument("--rate", type=float, default=RECAPTION_RATE, help="правок в минуту")
+    p.add_argument("--restart", action="store_true", help="игнорировать checkpoint и начать с начала")
+    p.add_argument("--dry-run", action="store_true", help="только посчитать посты, которые изменятся")
+    p = sub.add_parser("export", help="выгрузить архив в JSONL/CSV ('-' — в stdout)")
+    p.add_argument("file")
+    p.add_argument("--format", choices=("jsonl", "csv"), help="по умолчанию — по расширению файла")
+    p.add_argument("--batch", type=int, default=EXPORT_BATCH, help="строк на одно чтение")
+    p = sub.add_parser("api", help="JSON API только на чтение: GET /refs, /refs/ID")
+    p.add_argument("--host", default=API_HOST)
+    p.add_argument("--port", type=int, default=API_PORT)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.command == "backfill":
+        try:
+            asyncio.run(backfill(args.file, args.workers, args.per_host, args.chunk, args.publish, args.restart))
+        except KeyboardInterrupt:
+            print("Прервано — следующий запуск продолжит с checkpoint")
+        return
+    if args.command == "export":
+        fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "jsonl")
+        asyncio.run(export(args.file, fmt, max(1, args.batch)))
+        return
+    if args.command == "api":
+        asyncio.run(serve_api(args.host, args.port))
+        return
+    if args.command == "recaption":
+        try:
+            asyncio.run(recaption(args.rate, args.restart, args.dry_run))
+        except KeyboardInterrupt:
+            print("Прервано — следующий запуск продолжит с checkpoint")
+        return
     try:
         asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
-        print("Bot stopped")
\ No newline at end of file
+        log.info("Bot stopped")
+
+if __name__ == "__main__":
+    cli()
\ No newline at end of file
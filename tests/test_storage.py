@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from aiogram.fsm.storage.base import StorageKey  # noqa: E402
+
+import main  # noqa: E402
+
+
+def skey(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+class SQLiteStorageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        main.db.open(os.path.join(tmp.name, "references.db"))
+        main.db.submit(main.migrate).result()
+        self.storage = main.SQLiteStorage(hot_size=2)
+
+    async def asyncTearDown(self):
+        if self.storage._flush_task is not None:
+            self.storage._flush_task.cancel()
+        await main.db.close()
+
+    async def rows(self):
+        return dict(await main.db.read(lambda conn: conn.execute(
+            "SELECT key, data FROM fsm_sessions",
+        ).fetchall()))
+
+    async def test_updates_within_window_coalesce_into_one_write(self):
+        write = mock.AsyncMock(wraps=main.db.write)
+        with mock.patch.object(main.db, "write", write):
+            await self.storage.set_state(skey(1), "AddFlow:media")
+            for i in range(5):
+                await self.storage.update_data(skey(1), {"n": i})
+            await self.storage._flush_task
+        self.assertEqual(write.await_count, 1)
+        self.assertEqual(await self.rows(), {self.storage._key(skey(1)): '{"n": 4}'})
+
+    async def test_cleared_session_is_deleted(self):
+        await self.storage.set_data(skey(1), {"a": 1})
+        await self.storage.flush()
+        await self.storage.set_data(skey(1), {})
+        await self.storage.flush()
+        self.assertEqual(await self.rows(), {})
+
+    async def test_eviction_keeps_dirty_and_reloads_from_db(self):
+        for uid in (1, 2, 3):
+            await self.storage.set_data(skey(uid), {"uid": uid})
+        self.assertEqual(len(self.storage._hot), 3)  # грязные не вытесняются до flush
+        await self.storage.flush()
+        self.assertEqual(len(self.storage._hot), 2)
+        self.assertNotIn(self.storage._key(skey(1)), self.storage._hot)
+        self.assertEqual(await self.storage.get_data(skey(1)), {"uid": 1})
+
+    async def test_failed_write_keeps_keys_dirty(self):
+        await self.storage.set_data(skey(1), {"a": 1})
+        with mock.patch.object(main.db, "write", mock.AsyncMock(side_effect=OSError("disk full"))):
+            with self.assertRaises(OSError):
+                await self.storage.flush()
+        self.assertIn(self.storage._key(skey(1)), self.storage._dirty)
+        await self.storage.flush()
+        self.assertEqual(self.storage._dirty, set())
+        self.assertEqual(await self.rows(), {self.storage._key(skey(1)): '{"a": 1}'})
+
+    async def test_background_flush_failure_is_logged(self):
+        with mock.patch.object(main.db, "write", mock.AsyncMock(side_effect=OSError("disk full"))):
+            with self.assertLogs("refbot", "ERROR") as logs:
+                await self.storage.set_data(skey(1), {"a": 1})
+                await asyncio.wait_for(self.storage._flush_task, 5)
+        self.assertIn("FSM flush failed", logs.output[0])
+        self.assertIn(self.storage._key(skey(1)), self.storage._dirty)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import main  # noqa: E402
+
+
+class CanonicalUrlTest(unittest.TestCase):
+    def test_strips_www_tracking_fragment_and_sorts_query(self):
+        self.assertEqual(
+            main.canonical_url(" http://www.Example.com/a/b/?utm_source=x&b=2&a=1&fbclid=z#frag "),
+            "https://example.com/a/b?a=1&b=2",
+        )
+
+    def test_root_path_and_default_ports(self):
+        self.assertEqual(main.canonical_url("https://example.com"), "https://example.com/")
+        self.assertEqual(main.canonical_url("http://example.com:80/x"), "https://example.com/x")
+        self.assertEqual(main.canonical_url("https://example.com:8443/x"), "https://example.com:8443/x")
+
+    def test_youtube_forms_collapse_to_one_key(self):
+        key = "https://youtube.com/watch?v=dQw4w9WgXcQ"
+        for url in (
+            "https://youtu.be/dQw4w9WgXcQ?si=abc",
+            "https://www.youtube.com/watch?v=dQw4w9WgXcQ&feature=share",
+            "https://m.youtube.com/shorts/dQw4w9WgXcQ",
+            "https://www.youtube.com/embed/dQw4w9WgXcQ",
+        ):
+            self.assertEqual(main.canonical_url(url), key, url)
+
+    def test_vimeo_and_instagram(self):
+        self.assertEqual(main.canonical_url("https://player.vimeo.com/video/12345?h=x"), "https://vimeo.com/12345")
+        self.assertEqual(
+            main.canonical_url("https://www.instagram.com/reel/Cabc_12-x/?igsh=zz"),
+            "https://instagram.com/p/Cabc_12-x",
+        )
+
+    def test_malformed_urls_do_not_raise(self):
+        self.assertEqual(main.canonical_url("https://example.com:99999/x"), "https://example.com:99999/x")
+        self.assertEqual(main.canonical_url("  http://[abc/  "), "http://[abc/")
+        self.assertEqual(main.url_host("http://[abc/"), "")
+        self.assertEqual(main.url_host("https://www.example.com:99999/x"), "example.com")
+
+
+class SplitQueryTest(unittest.TestCase):
+    def setUp(self):
+        bits = {"slowmo": 0, "drone": 1, "music": 2, "mo-control": 3}
+        patcher = mock.patch.dict(main.TAG_BITS, bits, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_text_only(self):
+        self.assertEqual(main.split_query("red car"), ("red car", [], [], None))
+
+    def test_tags_category_and_any_group(self):
+        self.assertEqual(
+            main.split_query("#auto night #slowmo #drone|mo_control"),
+            ("night", ["slowmo"], [["drone", "mo-control"]], "auto"),
+        )
+
+    def test_only_first_category_is_taken(self):
+        self.assertEqual(main.split_query("#auto #food"), ("#food", [], [], "auto"))
+
+    def test_ambiguous_and_unknown_hashtags_stay_in_text(self):
+        # music — и категория, и тег: решить нельзя, ищем текстом
+        self.assertEqual(main.split_query("#music #unknown"), ("#music #unknown", [], [], None))
+        self.assertEqual(main.split_query("#slowmo|unknown"), ("#slowmo|unknown", [], [], None))
+
+
+if __name__ == "__main__":
+    unittest.main()